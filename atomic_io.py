@@ -0,0 +1,36 @@
+import os
+import uuid
+from contextlib import contextmanager
+from pathlib import Path
+from typing import IO, Iterator, Union
+
+PathLike = Union[str, Path]
+
+"""
+Atomic file writes: files are written to a temporary file in the same folder, which replaces
+the destination when complete, such that readers (and concurrent processes) never see a
+partially written file.
+"""
+
+
+@contextmanager
+def atomic_open(path: PathLike, mode: str = "wb") -> Iterator[IO]:
+    """Open a temporary file next to path for writing, which replaces path when closed without error"""
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}")
+    try:
+        with open(tmp_path, mode) as fp:
+            yield fp
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            tmp_path.unlink()
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def atomic_write_bytes(path: PathLike, content: bytes) -> None:
+    """Write content to path atomically"""
+    with atomic_open(path) as fp:
+        fp.write(content)
@@ -0,0 +1,134 @@
+import math
+import os
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Iterator, Optional, Tuple
+
+"""
+CPU configuration of the algorithm: the effective number of CPUs is derived from the CPU
+affinity mask and the CPU quota of the container (cgroup v1 or v2, e.g., `docker run --cpus=8`),
+instead of the number of CPUs of the host. Thread counts of PyTorch, OpenMP, SimpleITK and
+the preprocessing workers are derived from it, such that the container is not oversubscribed.
+
+Environment variables override the detected values:
+- PROSTATE_NUM_CPUS: effective number of CPUs
+- PROSTATE_TORCH_THREADS: PyTorch and ONNX Runtime intra-op threads (per worker process)
+- OMP_NUM_THREADS: OpenMP (and MKL) threads
+- PROSTATE_SITK_THREADS: SimpleITK threads (per filter, per worker process)
+- PROSTATE_IO_WORKERS: scans read and resampled concurrently (per case, per worker process)
+- PROSTATE_PREPROCESSING_THREADS, PROSTATE_NIFTI_SAVE_THREADS: nnUNet_predict (cli backend)
+"""
+
+CGROUP_ROOT = Path("/sys/fs/cgroup")
+PROC_CGROUP = Path("/proc/self/cgroup")
+
+
+@dataclass(frozen=True)
+class CPUConfig:
+    num_cpus: int
+    source: str
+    torch_threads: int
+    omp_threads: int
+    sitk_threads: int
+    io_workers: int
+    preprocessing_threads: int
+    nifti_save_threads: int
+
+
+def cgroup_dirs(controller: str) -> Iterator[Tuple[int, Path]]:
+    """Folders of the cgroup of this process and its ancestors, as (cgroup version, folder)"""
+    try:
+        lines = PROC_CGROUP.read_text().splitlines()
+    except OSError:
+        return
+    for line in lines:
+        hierarchy_id, controllers, cgroup_path = line.split(":", 2)
+        if hierarchy_id == "0" and controllers == "":
+            version, mounts = 2, [CGROUP_ROOT]
+        elif controller in controllers.split(","):
+            version, mounts = 1, [CGROUP_ROOT / controllers, CGROUP_ROOT / controller]
+        else:
+            continue
+        for mount in mounts:
+            # the cgroup path is relative to the mount, or the mount is the cgroup itself (cgroup namespace)
+            path = Path(cgroup_path)
+            for parent in [path, *path.parents]:
+                folder = mount / str(parent).lstrip("/")
+                if folder.is_dir():
+                    yield version, folder
+
+
+def cgroup_cpu_quota() -> Optional[float]:
+    """CPU quota (number of CPUs) of the cgroup of this process and its ancestors, if limited"""
+    quotas = []
+    for version, folder in cgroup_dirs("cpu"):
+        try:
+            if version == 2:
+                quota, period = (folder / "cpu.max").read_text().split()
+                if quota != "max":
+                    quotas.append(int(quota) / int(period))
+            else:
+                quota = int((folder / "cpu.cfs_quota_us").read_text())
+                period = int((folder / "cpu.cfs_period_us").read_text())
+                if quota > 0:
+                    quotas.append(quota / period)
+        except (OSError, ValueError):
+            continue
+    return min(quotas) if quotas else None
+
+
+def env_int(name: str) -> Optional[int]:
+    value = os.environ.get(name)
+    if value is None or value.strip() == "":
+        return None
+    try:
+        return max(1, int(value))
+    except ValueError:
+        raise ValueError(f"Environment variable {name} must be an integer, got {value!r}")
+
+
+def effective_cpu_count() -> Tuple[int, str]:
+    """Number of CPUs available to this process (affinity mask and cgroup quota), and where it comes from"""
+    num_cpus = env_int("PROSTATE_NUM_CPUS")
+    if num_cpus is not None:
+        return num_cpus, "PROSTATE_NUM_CPUS"
+
+    num_cpus, source = len(os.sched_getaffinity(0)), "affinity mask"
+    quota = cgroup_cpu_quota()
+    if quota is not None and math.ceil(quota) < num_cpus:
+        num_cpus, source = max(1, math.ceil(quota)), f"cgroup quota ({quota:g} CPUs)"
+    return num_cpus, source
+
+
+def detect_cpu_config(num_workers: int = 1, num_sequences: int = 3) -> CPUConfig:
+    """
+    Thread counts (per worker process) for the effective number of CPUs: the CPUs are divided
+    between the worker processes, and the CPUs of a worker between the sequences that are
+    resampled concurrently (SimpleITK threads)
+    """
+    num_cpus, source = effective_cpu_count()
+    cpus_per_worker = max(1, num_cpus // num_workers)
+    torch_threads = env_int("PROSTATE_TORCH_THREADS") or cpus_per_worker
+    io_workers = env_int("PROSTATE_IO_WORKERS") or min(num_sequences, cpus_per_worker)
+    return CPUConfig(
+        num_cpus=num_cpus,
+        source=source,
+        torch_threads=torch_threads,
+        omp_threads=env_int("OMP_NUM_THREADS") or torch_threads,
+        sitk_threads=env_int("PROSTATE_SITK_THREADS") or max(1, cpus_per_worker // io_workers),
+        io_workers=io_workers,
+        preprocessing_threads=env_int("PROSTATE_PREPROCESSING_THREADS") or max(1, min(6, num_cpus // 2)),
+        nifti_save_threads=env_int("PROSTATE_NIFTI_SAVE_THREADS") or max(1, min(2, num_cpus // 4)),
+    )
+
+
+def apply_cpu_config(config: CPUConfig) -> None:
+    """Set the thread counts of PyTorch, OpenMP/MKL (also for subprocesses) and SimpleITK"""
+    import SimpleITK as sitk
+    import torch
+
+    os.environ["OMP_NUM_THREADS"] = str(config.omp_threads)
+    os.environ["MKL_NUM_THREADS"] = str(config.omp_threads)
+    torch.set_num_threads(config.torch_threads)
+    sitk.ProcessObject.SetGlobalDefaultNumberOfThreads(config.sitk_threads)
+    print(f"CPU configuration: {asdict(config)}")
@@ -0,0 +1,196 @@
+import threading
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Dict, Iterable, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import SimpleITK as sitk
+
+PathLike = Union[str, Path]
+Region = Tuple[Tuple[int, ...], Tuple[int, ...]]  # (index, size), both in (x, y, z) order
+
+
+@dataclass(frozen=True)
+class ImageGeometry:
+    """Physical grid of an image: size (x, y, z), spacing, origin and direction"""
+    size: Tuple[int, ...]
+    spacing: Tuple[float, ...]
+    origin: Tuple[float, ...]
+    direction: Tuple[float, ...]
+
+    @classmethod
+    def from_image(cls, image: sitk.Image) -> "ImageGeometry":
+        return cls(
+            size=tuple(image.GetSize()),
+            spacing=tuple(image.GetSpacing()),
+            origin=tuple(image.GetOrigin()),
+            direction=tuple(image.GetDirection()),
+        )
+
+    @classmethod
+    def from_file(cls, path: PathLike) -> "ImageGeometry":
+        """Read geometry from the image header, without reading the pixel data"""
+        reader = sitk.ImageFileReader()
+        reader.SetFileName(str(path))
+        reader.ReadImageInformation()
+        return cls(
+            size=tuple(reader.GetSize()),
+            spacing=tuple(reader.GetSpacing()),
+            origin=tuple(reader.GetOrigin()),
+            direction=tuple(reader.GetDirection()),
+        )
+
+    def index_to_physical(self, index: np.ndarray) -> np.ndarray:
+        """Transform continuous indices of shape (N, 3) to physical points"""
+        direction = np.array(self.direction).reshape(3, 3)
+        return np.array(self.origin) + (np.array(index) * np.array(self.spacing)) @ direction.T
+
+    def physical_to_index(self, points: np.ndarray) -> np.ndarray:
+        """Transform physical points of shape (N, 3) to continuous indices"""
+        direction = np.array(self.direction).reshape(3, 3)
+        return ((np.array(points) - np.array(self.origin)) @ np.linalg.inv(direction).T) / np.array(self.spacing)
+
+    def region_geometry(self, region: Region) -> "ImageGeometry":
+        """Geometry of the specified region of this grid"""
+        index, size = region
+        origin = self.index_to_physical(np.array([index], dtype=float))[0]
+        return ImageGeometry(size=tuple(size), spacing=self.spacing, origin=tuple(origin), direction=self.direction)
+
+
+def centre_crop_region(geometry: ImageGeometry, physical_size: Sequence[float]) -> Region:
+    """
+    Region of a centre crop with the specified physical size in (z, y, x) order, equivalent
+    to picai_prep's crop_or_pad with crop_only=True (axes smaller than the crop are kept)
+    """
+    index, size = [], []
+    for shape, spacing, length in zip(geometry.size, geometry.spacing, physical_size[::-1]):
+        crop_size = int(np.round(length / spacing))
+        if shape < crop_size:
+            index.append(0)
+            size.append(shape)
+        else:
+            index.append(int(np.floor((shape - crop_size) / 2.)))
+            size.append(crop_size)
+    return tuple(index), tuple(size)
+
+
+def read_region(path: PathLike, region: Region) -> sitk.Image:
+    """Read region of an image. For uncompressed MHA files only the region is read from disk"""
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.SetExtractIndex([int(i) for i in region[0]])
+    reader.SetExtractSize([int(i) for i in region[1]])
+    return reader.Execute()
+
+
+def is_subgrid(image: sitk.Image, geometry: ImageGeometry, region: Region, tolerance: float = 1e-3) -> bool:
+    """Check whether the image grid is identical to the specified region of `geometry`"""
+    expected = geometry.region_geometry(region)
+    if tuple(image.GetSize()) != expected.size:
+        return False
+    if not np.allclose(image.GetSpacing(), expected.spacing, rtol=tolerance, atol=0):
+        return False
+    if not np.allclose(image.GetDirection(), expected.direction, atol=tolerance):
+        return False
+
+    # origin offset should be well below one voxel
+    offset = geometry.physical_to_index(np.array([image.GetOrigin()])) - np.array([region[0]])
+    return bool(np.all(np.abs(offset) < tolerance))
+
+
+def paste_to_geometry(image: sitk.Image, geometry: ImageGeometry, region: Region) -> sitk.Image:
+    """
+    Paste image into a zero-initialised image with the specified grid, at the index of
+    `region`. Only valid if `is_subgrid(image, geometry, region)`.
+    """
+    canvas = sitk.Image([int(i) for i in geometry.size], image.GetPixelID())
+    canvas.SetSpacing(geometry.spacing)
+    canvas.SetOrigin(geometry.origin)
+    canvas.SetDirection(geometry.direction)
+    return sitk.Paste(canvas, image, image.GetSize(), [0, 0, 0], [int(i) for i in region[0]])
+
+
+def resample_to_geometry(
+    image: sitk.Image,
+    geometry: ImageGeometry,
+    interpolator: int = sitk.sitkNearestNeighbor,
+) -> sitk.Image:
+    """Resample image to the specified grid, equivalent to picai_prep's resample_to_reference_scan"""
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetSize(geometry.size)
+    resampler.SetOutputSpacing(geometry.spacing)
+    resampler.SetOutputOrigin(geometry.origin)
+    resampler.SetOutputDirection(geometry.direction)
+    resampler.SetInterpolator(interpolator)
+    resampler.SetDefaultPixelValue(0)
+    return resampler.Execute(image)
+
+
+def gland_volume(pred: sitk.Image) -> float:
+    """Volume of the segmented prostate gland in mL"""
+    return float(np.sum(sitk.GetArrayViewFromImage(pred) > 0) * np.prod(pred.GetSpacing()) / 1000)
+
+
+class ImageCache:
+    """
+    Access layer for input scans: decoded volumes are memoized until evicted, such
+    that no scan is read twice, and geometry is read from the header only (or taken
+    from a previously decoded volume).
+    """
+
+    def __init__(self):
+        self._images: Dict[Tuple[str, Optional[Region]], sitk.Image] = {}
+        self._geometries: Dict[str, ImageGeometry] = {}
+        self._lock = threading.Lock()
+
+    def read_image(self, path: PathLike, region: Optional[Region] = None) -> sitk.Image:
+        """
+        Read (or retrieve the previously read) image, or region of an image. A region of
+        a previously read full image is cropped from memory instead of read from disk.
+        """
+        key = str(path)
+        image_key = (key, region)
+        with self._lock:
+            if image_key in self._images:
+                return self._images[image_key]
+            full_image = self._images.get((key, None))
+
+        if region is None:
+            image = sitk.ReadImage(key)
+        elif full_image is not None:
+            image = sitk.RegionOfInterest(full_image, [int(i) for i in region[1]], [int(i) for i in region[0]])
+        else:
+            image = read_region(key, region)
+        with self._lock:
+            self._images[image_key] = image
+            if region is None:
+                self._geometries[key] = ImageGeometry.from_image(image)
+        return image
+
+    def read_geometry(self, path: PathLike) -> ImageGeometry:
+        """Read (or retrieve the previously read) geometry of an image"""
+        key = str(path)
+        with self._lock:
+            if key in self._geometries:
+                return self._geometries[key]
+
+        geometry = ImageGeometry.from_file(key)
+        with self._lock:
+            self._geometries[key] = geometry
+        return geometry
+
+    def release_images(self, paths: Iterable[PathLike]) -> None:
+        """Drop the decoded volumes (and regions), while keeping their geometry"""
+        keys = [str(path) for path in paths]
+        with self._lock:
+            for image_key in list(self._images):
+                if image_key[0] in keys:
+                    del self._images[image_key]
+
+    def evict(self, paths: Iterable[PathLike]) -> None:
+        """Drop all cached information of the specified images"""
+        paths = list(paths)
+        self.release_images(paths)
+        with self._lock:
+            for path in paths:
+                self._geometries.pop(str(path), None)
@@ -0,0 +1,257 @@
+import base64
+import binascii
+import itertools
+import json
+import queue
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import numpy as np
+import SimpleITK as sitk
+
+from image_io import gland_volume
+
+"""
+Long-running inference service for the prostate segmentation algorithm. The models are
+loaded once, and bpMRI cases (T2W, ADC and HBV) are submitted over HTTP on localhost.
+Requests are preprocessed concurrently, and queued requests are grouped into batched
+forward passes by a single inference thread.
+
+Endpoints:
+- POST /segment: JSON with local paths {"scans": [t2w, adc, hbv]} or uploaded .mha files
+  {"files": [t2w, adc, hbv]} (base64 encoded). Optional: "output_path" to store the mask,
+  "return_mask" (default: true) to include the mask in the response (base64 encoded .mha).
+  Returns the prostate volume in mL.
+- GET /metrics: queue depth, batch sizes and latency percentiles.
+- GET /health
+"""
+
+
+class InferenceService:
+    """Queue of preprocessed cases, segmented in batches by a single inference thread"""
+
+    def __init__(self, algorithm, max_batch_size: int = 4, max_wait: float = 0.05, num_latencies: int = 1000):
+        self.algorithm = algorithm
+        self.predictor = algorithm.get_predictor(**algorithm.nnunet_settings, backend=algorithm.backend)
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.queue = queue.Queue()
+        self.case_ids = itertools.count()
+
+        # metrics, over the most recent requests
+        self.lock = threading.Lock()
+        self.num_requests = 0
+        self.num_errors = 0
+        self.batch_sizes = deque(maxlen=num_latencies)
+        self.latencies = {
+            "total": deque(maxlen=num_latencies),
+            "queue": deque(maxlen=num_latencies),
+            "inference": deque(maxlen=num_latencies),
+        }
+
+        self.worker = threading.Thread(target=self.run, daemon=True)
+        self.worker.start()
+
+    def run(self) -> None:
+        """Inference loop: wait for a request, and group it with requests that arrive within max_wait"""
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            batch = [item]
+            deadline = time.perf_counter() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    break
+                try:
+                    item = self.queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if item is None:
+                    self.queue.put(None)
+                    break
+                batch.append(item)
+            self.predict_batch(batch)
+
+    def predict_batch(self, batch: List[Dict[str, Any]]) -> None:
+        """Segment a batch of preprocessed cases in batched forward passes, and resolve their futures"""
+        start = time.perf_counter()
+        try:
+            softmaxes = self.predictor.predict_softmax_batch(
+                [item["data"] for item in batch], do_tta=self.algorithm.do_tta, step_size=self.algorithm.step_size
+            )
+        except Exception as e:
+            for item in batch:
+                item["future"].set_exception(e)
+            return
+
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.batch_sizes.append(len(batch))
+            for item in batch:
+                self.latencies["queue"].append(start - item["queued"])
+                self.latencies["inference"].append(latency)
+        for item, softmax in zip(batch, softmaxes):
+            item["future"].set_result(softmax)
+
+    def segment(self, scan_paths: List[Path], output_path: Optional[Path] = None) -> Dict[str, Any]:
+        """Segment a single case, returns the prostate segmentation (on the T2W grid) and its volume"""
+        start = time.perf_counter()
+        case_id = f"request_{next(self.case_ids)}"
+        try:
+            # preprocessing and export run in the request thread, concurrently with other requests
+            scans = self.algorithm.preprocess_input(scan_paths=scan_paths, case_id=case_id)
+            data, properties = self.predictor.preprocess_images(scans)
+
+            future = Future()
+            self.queue.put(dict(data=data, future=future, queued=time.perf_counter()))
+            softmax = future.result()
+
+            # the probability map (see probability_map.py) is written next to the segmentation
+            probability_path = None
+            if self.algorithm.probability_map is not None and output_path is not None:
+                probability_path = Path(output_path).with_suffix(".pmap")
+                probability_settings = dict(probability_file=str(probability_path),
+                                            probability_dtype=self.algorithm.probability_map)
+            else:
+                probability_settings = {}
+            pred = self.predictor.export_segmentation(softmax, properties, **probability_settings)
+            pred = self.algorithm.restore_original_space(pred, scan_paths=scan_paths, case_id=case_id)
+            if output_path is not None:
+                sitk.WriteImage(pred, str(output_path), True)
+        except Exception:
+            with self.lock:
+                self.num_errors += 1
+            raise
+        finally:
+            self.algorithm.crop_regions.pop(case_id, None)
+            self.algorithm.image_cache.evict(scan_paths)
+
+        volume = gland_volume(pred)
+        latency = time.perf_counter() - start
+        with self.lock:
+            self.num_requests += 1
+            self.latencies["total"].append(latency)
+        return dict(case_id=case_id, pred=pred, volume_ml=volume, latency_s=latency, probability_path=probability_path)
+
+    def metrics(self) -> Dict[str, Any]:
+        """Queue depth, batch sizes and latency percentiles (in seconds) of the most recent requests"""
+        with self.lock:
+            batch_sizes = list(self.batch_sizes)
+            latencies = {name: list(values) for name, values in self.latencies.items()}
+            metrics = dict(
+                queue_depth=self.queue.qsize(),
+                num_requests=self.num_requests,
+                num_errors=self.num_errors,
+                num_batches=len(batch_sizes),
+            )
+        metrics["batch_size"] = dict(
+            mean=float(np.mean(batch_sizes)) if batch_sizes else None,
+            max=int(np.max(batch_sizes)) if batch_sizes else None,
+            last=batch_sizes[-1] if batch_sizes else None,
+        )
+        for name, values in latencies.items():
+            metrics[f"latency_{name}"] = {
+                f"p{q}": float(np.percentile(values, q)) if values else None
+                for q in (50, 90, 95, 99)
+            }
+        return metrics
+
+    def shutdown(self) -> None:
+        self.queue.put(None)
+        self.worker.join()
+
+
+def image_to_bytes(image: sitk.Image, suffix: str = ".mha") -> bytes:
+    """Encode an image in the specified file format"""
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = Path(tmp_dir) / f"image{suffix}"
+        sitk.WriteImage(image, str(path), True)
+        return path.read_bytes()
+
+
+class ServiceRequestHandler(BaseHTTPRequestHandler):
+    service: InferenceService = None
+
+    def send_json(self, content: Dict[str, Any], status: int = 200) -> None:
+        body = json.dumps(content).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path == "/metrics":
+            self.send_json(self.service.metrics())
+        elif self.path == "/health":
+            self.send_json(dict(status="ok"))
+        else:
+            self.send_json(dict(error=f"Unknown endpoint: {self.path}"), status=404)
+
+    def do_POST(self):
+        if self.path != "/segment":
+            self.send_json(dict(error=f"Unknown endpoint: {self.path}"), status=404)
+            return
+
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            try:
+                request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                if not isinstance(request, dict):
+                    raise ValueError("expected a JSON object")
+                if "files" in request:
+                    # uploaded scans are stored temporarily, such that they can be read like local scans
+                    scan_paths = []
+                    for i, content in enumerate(request["files"]):
+                        path = Path(tmp_dir) / f"scan_{i:04d}.mha"
+                        path.write_bytes(base64.b64decode(content))
+                        scan_paths.append(path)
+                else:
+                    scan_paths = [Path(path) for path in request.get("scans", [])]
+            except (ValueError, KeyError, TypeError, binascii.Error) as e:
+                self.send_json(dict(error=f"Invalid request: {type(e).__name__}: {e}"), status=400)
+                return
+
+            if len(scan_paths) != 3:
+                self.send_json(dict(error="Provide three scans (T2W, ADC and HBV)"), status=400)
+                return
+            missing = [str(path) for path in scan_paths if not path.exists()]
+            if missing:
+                self.send_json(dict(error=f"Scans not found: {missing}"), status=400)
+                return
+
+            try:
+                result = self.service.segment(scan_paths, output_path=request.get("output_path"))
+            except Exception as e:
+                self.send_json(dict(error=f"{type(e).__name__}: {e}"), status=500)
+                return
+
+        response = dict(case_id=result["case_id"], volume_ml=result["volume_ml"], latency_s=result["latency_s"])
+        if result["probability_path"] is not None:
+            response["probability_map"] = str(result["probability_path"])
+        if request.get("return_mask", True):
+            response["mask"] = base64.b64encode(image_to_bytes(result["pred"])).decode("ascii")
+        self.send_json(response)
+
+
+def serve(algorithm, port: int = 8000, max_batch_size: int = 4, max_wait: float = 0.05) -> None:
+    """Run the inference service on localhost until interrupted"""
+    service = InferenceService(algorithm, max_batch_size=max_batch_size, max_wait=max_wait)
+    handler = type("Handler", (ServiceRequestHandler,), dict(service=service))
+    server = ThreadingHTTPServer(("127.0.0.1", port), handler)
+    print(f"Serving prostate segmentation on http://127.0.0.1:{port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.shutdown()
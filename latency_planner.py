@@ -0,0 +1,202 @@
+import argparse
+import hashlib
+import json
+import platform
+import time
+from dataclasses import asdict, dataclass
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from cpu_config import effective_cpu_count
+
+"""
+Planner for the inference settings (mirror axes for test-time augmentation, sliding-window
+step size and number of folds), which picks the most accurate setting that fits a latency
+budget (seconds per case) on the current machine.
+
+- The accuracy of each setting is measured once on labelled cases (e.g., the cross-validation
+  cases), and stored next to the checkpoints (inference_accuracy.json).
+- The latency of each setting is benchmarked on the current machine, and stored such that
+  subsequent start-ups do not benchmark again (latency_benchmark_[machine].json).
+"""
+
+ACCURACY_FILENAME = "inference_accuracy.json"
+
+
+@dataclass(frozen=True)
+class InferenceSetting:
+    mirror_axes: Tuple[int, ...]
+    step_size: float
+    num_folds: int
+
+    @property
+    def key(self) -> str:
+        return f"mirror_axes={','.join(map(str, self.mirror_axes))};step_size={self.step_size};num_folds={self.num_folds}"
+
+
+def candidate_mirror_axes(mirror_axes: Sequence[int]) -> List[Tuple[int, ...]]:
+    """No mirroring, and mirroring along an increasing number of axes (up to the axes used in training)"""
+    mirror_axes = tuple(mirror_axes)
+    return [mirror_axes[len(mirror_axes) - k:] for k in range(len(mirror_axes) + 1)]
+
+
+def predict_fold_softmaxes(predictor, data: np.ndarray, mirror_axes: Tuple[int, ...], step_size: float):
+    """Softmax of each fold (in order) with the specified mirror axes and step size"""
+    default_mirror_axes = predictor.sliding_window.mirror_axes
+    predictor.sliding_window.mirror_axes = mirror_axes
+    try:
+        for i in range(len(predictor.folds)):
+            yield predictor.predict_fold_softmax(i, data, do_tta=len(mirror_axes) > 0, step_size=step_size)
+    finally:
+        predictor.sliding_window.mirror_axes = default_mirror_axes
+
+
+def measure_accuracy(predictor, input_files: Dict[str, List[str]], labels_dir: Path,
+                     step_sizes: Sequence[float] = (0.5, 0.75, 1.0)) -> Dict[str, float]:
+    """
+    Mean Dice score of each setting. The ensemble of k folds uses the first k folds of the predictor,
+    such that the softmax of each fold is computed once per mirror axes and step size.
+    """
+    from softmax_store import dice_score
+
+    scores: Dict[str, List[float]] = {}
+    for case_id, files in input_files.items():
+        data, _, properties = predictor.trainer.preprocess_patient(files)
+        lbl = sitk.GetArrayFromImage(sitk.ReadImage(str(Path(labels_dir) / f"{case_id}.nii.gz")))
+        for mirror_axes in candidate_mirror_axes(predictor.sliding_window.mirror_axes):
+            for step_size in step_sizes:
+                softmax = None
+                for k, fold_softmax in enumerate(predict_fold_softmaxes(predictor, data, mirror_axes, step_size), 1):
+                    softmax = fold_softmax if softmax is None else softmax + fold_softmax
+                    pred = predictor.export_segmentation(predictor.transpose_backward(softmax / k), properties)
+                    setting = InferenceSetting(mirror_axes=mirror_axes, step_size=step_size, num_folds=k)
+                    scores.setdefault(setting.key, []).append(dice_score(sitk.GetArrayViewFromImage(pred), lbl))
+        print(f"Measured accuracy for {case_id}")
+    return {key: float(np.mean(values)) for key, values in scores.items()}
+
+
+def benchmark_latency(predictor, shape: Sequence[int], step_sizes: Sequence[float] = (0.5, 0.75, 1.0),
+                      repeats: int = 2) -> Dict[str, float]:
+    """
+    Seconds per case for each setting, for preprocessed data of the specified shape. Each fold
+    takes the same time, so only the first fold is timed (the best of `repeats` runs).
+    """
+    data = np.random.RandomState(0).randn(predictor.trainer.num_input_channels, *shape).astype(np.float32)
+    num_folds = len(predictor.folds)
+
+    latencies = {}
+    for mirror_axes in candidate_mirror_axes(predictor.sliding_window.mirror_axes):
+        for step_size in step_sizes:
+            durations = []
+            for _ in range(repeats):
+                start = time.perf_counter()
+                next(predict_fold_softmaxes(predictor, data, mirror_axes, step_size))
+                durations.append(time.perf_counter() - start)
+            for k in range(1, num_folds + 1):
+                setting = InferenceSetting(mirror_axes=mirror_axes, step_size=step_size, num_folds=k)
+                latencies[setting.key] = k * min(durations)
+    return latencies
+
+
+def machine_fingerprint(settings: dict) -> str:
+    """Identity of the machine (CPU, threads, GPU) and the inference settings the benchmark is valid for"""
+    machine = dict(
+        processor=platform.processor() or platform.machine(),
+        num_cpus=effective_cpu_count()[0],
+        num_threads=torch.get_num_threads(),
+        gpu=torch.cuda.get_device_name(0) if torch.cuda.is_available() else None,
+        torch=torch.__version__,
+        **settings,
+    )
+    return hashlib.sha256(json.dumps(machine, sort_keys=True, default=str).encode("utf-8")).hexdigest()[:16]
+
+
+def select_setting(accuracy: Dict[str, float], latency: Dict[str, float], latency_budget: float) -> InferenceSetting:
+    """Most accurate setting within the latency budget (or the fastest setting, if none fits)"""
+    keys = [key for key in accuracy if key in latency]
+    if not keys:
+        raise ValueError("No setting with both accuracy and latency measurements")
+    within_budget = [key for key in keys if latency[key] <= latency_budget]
+    if within_budget:
+        key = max(within_budget, key=lambda k: (accuracy[k], -latency[k]))
+    else:
+        key = min(keys, key=lambda k: latency[k])
+        print(f"No inference setting fits the latency budget of {latency_budget:.1f} s, using the fastest setting")
+    return parse_setting(key)
+
+
+def parse_setting(key: str) -> InferenceSetting:
+    values = dict(item.split("=") for item in key.split(";"))
+    return InferenceSetting(
+        mirror_axes=tuple(int(a) for a in values["mirror_axes"].split(",") if a),
+        step_size=float(values["step_size"]),
+        num_folds=int(values["num_folds"]),
+    )
+
+
+def plan_inference(
+    model_folder: Path,
+    latency_budget: float,
+    load_predictor,
+    shape_fn,
+    settings: dict,
+    plan_dir: Optional[Path] = None,
+) -> InferenceSetting:
+    """
+    Select the inference setting for the latency budget. The predictor (load_predictor()) is only
+    loaded when the latency has not been benchmarked on this machine before. shape_fn(predictor)
+    gives the shape of the preprocessed data to benchmark with.
+    """
+    model_folder = Path(model_folder)
+    plan_dir = model_folder if plan_dir is None else Path(plan_dir)
+    accuracy_path = model_folder / ACCURACY_FILENAME
+    if not accuracy_path.exists():
+        raise FileNotFoundError(f"Accuracy of the inference settings not found at {accuracy_path}, "
+                                "please run `python latency_planner.py` first")
+    accuracy = json.loads(accuracy_path.read_text())
+
+    benchmark_path = plan_dir / f"latency_benchmark_{machine_fingerprint(settings)}.json"
+    if benchmark_path.exists():
+        latency = json.loads(benchmark_path.read_text())
+    else:
+        print("Benchmarking inference settings on this machine")
+        predictor = load_predictor()
+        latency = benchmark_latency(predictor, shape=shape_fn(predictor))
+        plan_dir.mkdir(parents=True, exist_ok=True)
+        benchmark_path.write_text(json.dumps(latency, indent=4))
+
+    setting = select_setting(accuracy, latency, latency_budget)
+    print(f"Inference setting for a latency budget of {latency_budget:.1f} s: {asdict(setting)} "
+          f"(Dice {accuracy[setting.key]:.4f}, {latency[setting.key]:.1f} s per case)")
+    return setting
+
+
+if __name__ == "__main__":
+    from network_export import (add_model_arguments, collect_input_files,
+                                model_folder_from_args, parse_folds)
+
+    parser = argparse.ArgumentParser(description="Measure the accuracy of the inference settings on labelled cases")
+    add_model_arguments(parser)
+    parser.add_argument("--cases_dir", type=Path, required=True,
+                        help="Cases in nnUNet Raw Data Archive format (e.g., imagesTr)")
+    parser.add_argument("--labels_dir", type=Path, required=True,
+                        help="Annotations of the cases (e.g., labelsTr)")
+    parser.add_argument("--num_cases", type=int, default=None)
+    args = parser.parse_args()
+
+    from nnunet_predictor import EnsemblePredictor
+
+    model_folder = model_folder_from_args(args)
+    predictor = EnsemblePredictor(
+        model_folder=model_folder,
+        folds=parse_folds(args.folds),
+        checkpoint=args.checkpoint,
+    )
+    accuracy = measure_accuracy(predictor, collect_input_files(args.cases_dir, num_cases=args.num_cases),
+                                labels_dir=args.labels_dir)
+    (model_folder / ACCURACY_FILENAME).write_text(json.dumps(accuracy, indent=4))
+    for key, dice in sorted(accuracy.items(), key=lambda item: -item[1]):
+        print(f"{key}: Dice {dice:.4f}")
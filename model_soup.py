@@ -0,0 +1,113 @@
+import argparse
+from collections import OrderedDict
+from pathlib import Path
+from shutil import copyfile
+from typing import Dict, List, Optional
+
+import numpy as np
+import torch
+
+"""
+Merge the networks of the cross-validation folds into a single network ("fold soup"),
+by averaging their weights. The merged network is stored as an additional checkpoint of
+fold 0, such that it can be loaded like any other nnU-Net checkpoint.
+"""
+
+
+def average_state_dicts(state_dicts: List[Dict[str, torch.Tensor]]) -> Dict[str, torch.Tensor]:
+    """
+    Average weights of multiple networks with identical architecture. Normalisation layers:
+    - affine parameters (InstanceNorm/BatchNorm) are averaged like any other weight,
+    - running means (BatchNorm) are averaged, and running variances are pooled (mean of the
+      variances plus the variance of the means), as for the mixture of the fold statistics,
+    - the number of tracked batches is copied from the first network.
+    InstanceNorm without running statistics (as in nnU-Net's Generic_UNet) has no buffers.
+    """
+    averaged = OrderedDict()
+    for key, value in state_dicts[0].items():
+        tensors = [sd[key] for sd in state_dicts]
+        if not torch.is_floating_point(value):
+            averaged[key] = value.clone()
+        elif key.endswith("running_var"):
+            mean_key = key[:-len("running_var")] + "running_mean"
+            means = torch.stack([sd[mean_key].float() for sd in state_dicts])
+            variances = torch.stack([t.float() for t in tensors])
+            averaged[key] = (variances.mean(0) + means.var(0, unbiased=False)).to(value.dtype)
+        else:
+            averaged[key] = torch.stack([t.float() for t in tensors]).mean(0).to(value.dtype)
+    return averaged
+
+
+def recalibrate_batchnorm(network: torch.nn.Module, patches: List[np.ndarray]) -> None:
+    """Re-estimate BatchNorm running statistics of the merged network on calibration patches"""
+    bn_layers = [m for m in network.modules() if isinstance(m, torch.nn.modules.batchnorm._BatchNorm)]
+    if not bn_layers:
+        return
+
+    for m in bn_layers:
+        m.reset_running_stats()
+        m.momentum = None  # cumulative moving average
+    network.train()
+    with torch.no_grad():
+        for patch in patches:
+            network(torch.from_numpy(patch[None]))
+    network.eval()
+
+
+def create_model_soup(
+    model_folder: Path,
+    folds: List[int],
+    checkpoint: str = "model_final_checkpoint",
+    soup_checkpoint: str = "model_soup",
+    calibration_dir: Optional[Path] = None,
+) -> Path:
+    """Average the checkpoints of the specified folds and store as `fold_{folds[0]}/{soup_checkpoint}.model`"""
+    model_folder = Path(model_folder)
+    checkpoints = [
+        torch.load(model_folder / f"fold_{fold}" / f"{checkpoint}.model", map_location=torch.device('cpu'))
+        for fold in folds
+    ]
+
+    # keep the training metadata of the first fold, without optimizer state
+    soup = checkpoints[0]
+    soup['state_dict'] = average_state_dicts([c['state_dict'] for c in checkpoints])
+    soup['optimizer_state_dict'] = None
+    soup.pop('amp_grad_scaler', None)
+
+    if calibration_dir is not None:
+        from network_export import (collect_calibration_patches,
+                                    collect_input_files)
+        from nnunet_predictor import EnsemblePredictor
+
+        predictor = EnsemblePredictor(model_folder=model_folder, folds=folds[:1], checkpoint=checkpoint)
+        network = predictor.networks[0]
+        network.load_state_dict(soup['state_dict'])
+        network.do_ds = False
+        recalibrate_batchnorm(network, collect_calibration_patches(predictor, collect_input_files(calibration_dir)))
+        soup['state_dict'] = network.state_dict()
+
+    soup_path = model_folder / f"fold_{folds[0]}" / f"{soup_checkpoint}.model"
+    torch.save(soup, soup_path)
+    copyfile(model_folder / f"fold_{folds[0]}" / f"{checkpoint}.model.pkl", f"{soup_path}.pkl")
+    return soup_path
+
+
+if __name__ == "__main__":
+    from network_export import (add_model_arguments, model_folder_from_args,
+                                parse_folds)
+
+    parser = argparse.ArgumentParser(description="Merge the networks of all folds into a single network")
+    add_model_arguments(parser)
+    parser.add_argument("--calibration_dir", type=Path,
+                        help="Cases in nnUNet Raw Data Archive format to re-estimate BatchNorm statistics "
+                             "(only relevant for networks with BatchNorm)")
+    args = parser.parse_args()
+
+    model_folder = model_folder_from_args(args)
+    soup_path = create_model_soup(
+        model_folder=model_folder,
+        folds=parse_folds(args.folds),
+        checkpoint=args.checkpoint,
+        calibration_dir=args.calibration_dir,
+    )
+    print(f"Saved model soup to {soup_path}")
@@ -0,0 +1,237 @@
+import argparse
+from pathlib import Path
+from typing import Dict, List, Optional, Union
+
+import numpy as np
+import SimpleITK as sitk
+import torch
+from picai_prep.preprocessing import PreprocessingSettings, Sample
+
+from sliding_window import RunFunction
+
+ENGINE_EXTENSIONS = {
+    "torchscript": ".torchscript.pt",
+    "onnx": ".onnx",
+    "onnx_int8": ".int8.onnx",
+}
+
+
+def fold_folder(model_folder: Path, fold: Union[int, str]) -> Path:
+    """Folder with the checkpoints of a fold (fold_0, ..., or all)"""
+    return Path(model_folder) / ("all" if fold == "all" else f"fold_{fold}")
+
+
+def model_folder_path(results: Path, task: str, trainer: str, plans: str = "nnUNetPlansv2.1",
+                      network: str = "3d_fullres") -> Path:
+    """Folder of a trained nnU-Net model in the results folder"""
+    return Path(results) / "nnUNet" / network / task / f"{trainer}__{plans}"
+
+
+def parse_folds(folds: str) -> List[Union[int, str]]:
+    """Folds from a comma-separated string (e.g., 0,1,2,3,4 or all)"""
+    return [f if f == "all" else int(f) for f in folds.split(",")]
+
+
+def add_model_arguments(parser: argparse.ArgumentParser) -> None:
+    """Command line arguments that select the model, checkpoint and folds (see model_folder_from_args)"""
+    parser.add_argument("--results", type=Path, default=Path("/opt/algorithm/results"))
+    parser.add_argument("--task", default="Task2202_prostate_segmentation")
+    parser.add_argument("--trainer", default="nnUNetTrainerV2_Loss_FL_and_CE_checkpoints")
+    parser.add_argument("--plans", default="nnUNetPlansv2.1")
+    parser.add_argument("--checkpoint", default="model_final_checkpoint")
+    parser.add_argument("--folds", default="0,1,2,3,4")
+
+
+def model_folder_from_args(args: argparse.Namespace) -> Path:
+    """Model folder selected with the arguments of add_model_arguments"""
+    return model_folder_path(args.results, task=args.task, trainer=args.trainer, plans=args.plans)
+
+
+def exported_network_path(model_folder: Path, fold: Union[int, str], checkpoint: str, engine: str) -> Path:
+    """Location of the exported network of a fold, next to its checkpoint"""
+    return fold_folder(model_folder, fold) / f"{checkpoint}{ENGINE_EXTENSIONS[engine]}"
+
+
+def export_network(
+    network: torch.nn.Module,
+    num_input_channels: int,
+    patch_size: List[int],
+    path: Path,
+    engine: str = "onnx",
+) -> None:
+    """Export an nnU-Net network (without deep supervision) to a graph-optimised artifact"""
+    network = network.cpu().eval()
+    network.do_ds = False
+    dummy_input = torch.zeros((1, num_input_channels, *patch_size), dtype=torch.float32)
+
+    with torch.no_grad():
+        if engine == "torchscript":
+            traced = torch.jit.trace(network, dummy_input)
+            traced = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+            traced.save(str(path))
+        elif engine == "onnx":
+            torch.onnx.export(
+                network, dummy_input, str(path),
+                input_names=["data"], output_names=["logits"],
+                dynamic_axes={"data": {0: "batch"}, "logits": {0: "batch"}},
+                opset_version=13,
+            )
+        else:
+            raise ValueError(f"Unknown export engine: {engine}")
+
+
+def collect_input_files(raw_images_dir: Path, num_cases: Optional[int] = None) -> Dict[str, List[str]]:
+    """Collect the scans of each case in nnUNet Raw Data Archive format (e.g., imagesTr)"""
+    case_ids = sorted(set(path.name[:-len("_0000.nii.gz")] for path in Path(raw_images_dir).glob("*_0000.nii.gz")))
+    if num_cases is not None:
+        case_ids = case_ids[:num_cases]
+    return {
+        case_id: sorted(str(path) for path in Path(raw_images_dir).glob(f"{case_id}_[0-9][0-9][0-9][0-9].nii.gz"))
+        for case_id in case_ids
+    }
+
+
+def collect_calibration_patches(predictor, input_files: Dict[str, List[str]], patches_per_case: int = 4) -> List[np.ndarray]:
+    """Preprocess cases and select sliding-window patches (evenly spaced) for calibration"""
+    from batchgenerators.augmentations.utils import pad_nd_image
+
+    patches = []
+    for files in input_files.values():
+        data, _, _ = predictor.trainer.preprocess_patient(files)
+        padded = pad_nd_image(data, predictor.sliding_window.patch_size, "constant", {'constant_values': 0})
+        slicers = predictor.sliding_window.get_patch_slicers(padded.shape[1:], step_size=0.5)
+        for idx in np.linspace(0, len(slicers) - 1, min(patches_per_case, len(slicers))).astype(int):
+            patches.append(np.ascontiguousarray(padded[(slice(None),) + slicers[idx]], dtype=np.float32))
+    return patches
+
+
+def quantize_network(onnx_path: Path, path: Path, calibration_patches: List[np.ndarray]) -> None:
+    """Post-training static INT8 quantization of an exported ONNX network, calibrated on patches"""
+    from onnxruntime.quantization import (CalibrationDataReader, QuantFormat,
+                                          QuantType, quantize_static)
+
+    class PatchDataReader(CalibrationDataReader):
+        def __init__(self, patches):
+            self.iterator = iter([{"data": patch[None]} for patch in patches])
+
+        def get_next(self):
+            return next(self.iterator, None)
+
+    quantize_static(
+        str(onnx_path), str(path), PatchDataReader(calibration_patches),
+        quant_format=QuantFormat.QDQ, per_channel=True,
+        activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8,
+    )
+
+
+def load_exported_network(path: Path, engine: str, num_threads: int = 0) -> RunFunction:
+    """Load an exported network, returns a function that maps patches to logits"""
+    if engine == "torchscript":
+        module = torch.jit.load(str(path), map_location="cpu")
+
+        def run(x: np.ndarray) -> np.ndarray:
+            with torch.no_grad():
+                return module(torch.from_numpy(x)).numpy()
+
+        return run
+    elif engine in ("onnx", "onnx_int8"):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise ImportError("The onnx inference engine requires onnxruntime, please install it with "
+                              "`pip install onnxruntime`")
+
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        options.intra_op_num_threads = num_threads
+        session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        input_name = session.get_inputs()[0].name
+
+        def run(x: np.ndarray) -> np.ndarray:
+            return session.run(None, {input_name: x})[0]
+
+        return run
+    else:
+        raise ValueError(f"Unknown inference engine: {engine}")
+
+
+def validate_exported_networks(model_folder: Path, folds: List[int], checkpoint: str, engine: str,
+                               scan_paths: List[Path]) -> int:
+    """
+    Compare the exported ensemble against the eager PyTorch ensemble for a single case,
+    returns the number of voxels with a different segmentation
+    """
+    from nnunet_predictor import EnsemblePredictor
+
+    # preprocess case like process.py
+    sample = Sample(
+        scans=[sitk.ReadImage(str(path)) for path in scan_paths],
+        settings=PreprocessingSettings(physical_size=[81.0, 192.0, 192.0], crop_only=True),
+    )
+    sample.preprocess()
+
+    eager = EnsemblePredictor(model_folder=model_folder, folds=folds, checkpoint=checkpoint, engine="torch")
+    exported = EnsemblePredictor(model_folder=model_folder, folds=folds, checkpoint=checkpoint, engine=engine)
+    data, _ = eager.preprocess_images(sample.scans)
+
+    softmax_eager = eager.predict_softmax(data)
+    softmax_exported = exported.predict_softmax(data)
+    num_different = int((softmax_eager.argmax(0) != softmax_exported.argmax(0)).sum())
+    print(f"Maximum absolute softmax difference: {np.abs(softmax_eager - softmax_exported).max():.6f}")
+    print(f"Voxels different between eager and {engine} segmentation: {num_different}")
+    return num_different
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Export the nnU-Net network of each fold for CPU inference")
+    parser.add_argument("--engine", choices=list(ENGINE_EXTENSIONS), default="onnx")
+    add_model_arguments(parser)
+    parser.add_argument("--validate", type=Path, nargs=3, metavar=("T2W", "ADC", "HBV"),
+                        help="Compare against the eager ensemble for the specified scans")
+    parser.add_argument("--calibration_dir", type=Path,
+                        help="Cases in nnUNet Raw Data Archive format (e.g., imagesTr from training/prepare_data.py) "
+                             "to calibrate INT8 quantization (onnx_int8 only)")
+    parser.add_argument("--num_calibration_cases", type=int, default=5)
+    args = parser.parse_args()
+
+    if args.engine == "onnx_int8" and args.calibration_dir is None:
+        parser.error("--calibration_dir is required for INT8 quantization")
+
+    from nnunet_predictor import EnsemblePredictor
+
+    model_folder = model_folder_from_args(args)
+    folds = parse_folds(args.folds)
+    predictor = EnsemblePredictor(model_folder=model_folder, folds=folds, checkpoint=args.checkpoint)
+
+    if args.engine == "onnx_int8":
+        calibration_patches = collect_calibration_patches(
+            predictor, collect_input_files(args.calibration_dir, num_cases=args.num_calibration_cases)
+        )
+
+    for fold, network in zip(folds, predictor.networks):
+        path = exported_network_path(model_folder, fold, args.checkpoint, args.engine)
+        if args.engine == "onnx_int8":
+            # quantize the fp32 ONNX network (exported first, if needed)
+            onnx_path = exported_network_path(model_folder, fold, args.checkpoint, "onnx")
+            if not onnx_path.exists():
+                export_network(
+                    network,
+                    num_input_channels=predictor.trainer.num_input_channels,
+                    patch_size=predictor.trainer.patch_size,
+                    path=onnx_path,
+                    engine="onnx",
+                )
+            quantize_network(onnx_path, path, calibration_patches)
+        else:
+            export_network(
+                network,
+                num_input_channels=predictor.trainer.num_input_channels,
+                patch_size=predictor.trainer.patch_size,
+                path=path,
+                engine=args.engine,
+            )
+        print(f"Exported fold {fold} to {path}")
+
+    if args.validate:
+        num_different = validate_exported_networks(model_folder, folds, args.checkpoint, args.engine, args.validate)
+        exit(int(num_different > 10))
@@ -12,9 +12,17 @@
 #    See the License for the specific language governing permissions and
 #    limitations under the License.
 
+import os
+from copy import deepcopy
+
+import torch
+import torch.nn.functional as F
 from torch import nn
+from torch.cuda.amp import autocast
 
+from nnunet.training.model_restore import load_model_and_checkpoint_files
 from nnunet.training.network_training.nnUNetTrainerV2 import nnUNetTrainerV2
+from nnunet.utilities.to_torch import maybe_to_torch, to_cuda
 from nnunet.training.loss_functions.crossentropy import RobustCrossEntropyLoss
 from nnunet.training.network_training.nnUNet_variants.loss_function.nnUNetTrainerV2_focalLoss import FocalLoss
 # TODO: replace FocalLoss by fixed implemetation (and set smooth=0 in that one?)
@@ -43,6 +51,21 @@ class FL_and_CE_loss(nn.Module):
         return result
 
 
+class KD_loss(nn.Module):
+    """
+    Knowledge distillation loss: KL divergence between the (temperature-scaled) softmax of the student
+    and the soft targets of the teacher ensemble (probabilities, averaged over the teachers)
+    """
+    def __init__(self, temperature=1.0):
+        super(KD_loss, self).__init__()
+        self.temperature = temperature
+
+    def forward(self, net_output, soft_target):
+        log_probs = F.log_softmax(net_output.float() / self.temperature, dim=1)
+        kl = F.kl_div(log_probs, soft_target.float(), reduction="none").sum(1).mean()
+        return kl * self.temperature ** 2
+
+
 class nnUNetTrainerV2_Loss_FL_and_CE_checkpoints(nnUNetTrainerV2):
     """
     Set loss to FL + CE and set checkpoints
@@ -75,3 +98,130 @@ class nnUNetTrainerV2_Loss_FL_and_CE_checkpoints3(nnUNetTrainerV2_Loss_FL_and_CE
                  unpack_data=True, deterministic=True, fp16=False):
         super().__init__(plans_file, fold, output_folder, dataset_directory, batch_dice, stage, unpack_data,
                          deterministic, fp16)
+
+
+class nnUNetTrainerV2_Loss_FL_and_CE_distillation(nnUNetTrainerV2_Loss_FL_and_CE_checkpoints):
+    """
+    Train a lightweight student network (half the features, one convolution per stage) against the soft
+    outputs of the five-fold nnUNetTrainerV2_Loss_FL_and_CE_checkpoints ensemble, combined with FL + CE
+    against the annotations. The teacher ensemble is read from the results folder of the teacher trainer
+    (next to the results folder of this trainer), or from the nnUNet_distillation_teacher environment variable.
+    Intended to be trained with fold "all".
+    """
+    def __init__(self, plans_file, fold, output_folder=None, dataset_directory=None, batch_dice=True, stage=None,
+                 unpack_data=True, deterministic=True, fp16=False):
+        super().__init__(plans_file, fold, output_folder, dataset_directory, batch_dice, stage, unpack_data,
+                         deterministic, fp16)
+        self.student_base_num_features = 16
+        self.student_conv_per_stage = 1
+
+        self.teacher_trainer = "nnUNetTrainerV2_Loss_FL_and_CE_checkpoints"
+        self.teacher_folds = (0, 1, 2, 3, 4)
+        self.teacher_checkpoint = "model_final_checkpoint"
+        self.teacher_networks = []
+        self.distillation_weight = 0.5
+        self.kd_loss = KD_loss(temperature=2.0)
+
+        if output_folder is not None:
+            plans_identifier = os.path.basename(os.path.normpath(output_folder)).split("__")[-1]
+            self.teacher_folder = os.path.join(os.path.dirname(os.path.normpath(output_folder)),
+                                               f"{self.teacher_trainer}__{plans_identifier}")
+        else:
+            self.teacher_folder = None
+        self.teacher_folder = os.environ.get("nnUNet_distillation_teacher", self.teacher_folder)
+
+    def initialize_network(self):
+        self.base_num_features = self.student_base_num_features
+        self.conv_per_stage = self.student_conv_per_stage
+        super().initialize_network()
+
+    def initialize(self, training=True, force_load_plans=False):
+        super().initialize(training, force_load_plans)
+        if training and not self.teacher_networks:
+            self.load_teacher_networks()
+
+    def load_teacher_networks(self):
+        """Load the networks of the teacher ensemble (without deep supervision), kept frozen during training"""
+        self.print_to_log_file("loading teacher ensemble from", self.teacher_folder)
+        trainer, params = load_model_and_checkpoint_files(self.teacher_folder, folds=self.teacher_folds,
+                                                          mixed_precision=self.fp16,
+                                                          checkpoint_name=self.teacher_checkpoint)
+        for p in params:
+            trainer.load_checkpoint_ram(p, False)
+            network = deepcopy(trainer.network)
+            network.do_ds = False
+            network.eval()
+            for param in network.parameters():
+                param.requires_grad = False
+            if torch.cuda.is_available():
+                network.cuda()
+            self.teacher_networks.append(network)
+
+    def predict_soft_targets(self, data):
+        """Average of the temperature-scaled softmax predictions of the teacher ensemble"""
+        with torch.no_grad():
+            soft_target = None
+            for network in self.teacher_networks:
+                probs = F.softmax(network(data).float() / self.kd_loss.temperature, dim=1)
+                soft_target = probs if soft_target is None else soft_target + probs
+            return soft_target / len(self.teacher_networks)
+
+    def compute_loss(self, data, output, target):
+        """FL + CE against the annotations (deep supervision), and KD against the teachers (full resolution)"""
+        soft_target = self.predict_soft_targets(data)
+        output_full_res = output[0] if isinstance(output, (tuple, list)) else output
+        return (1 - self.distillation_weight) * self.loss(output, target) + \
+            self.distillation_weight * self.kd_loss(output_full_res, soft_target)
+
+    def run_iteration(self, data_generator, do_backprop=True, run_online_evaluation=False):
+        """
+        Same as nnUNetTrainerV2.run_iteration, with the distillation loss. The teacher ensemble is only
+        evaluated for training iterations, the validation loss is FL + CE only (comparable to the teachers).
+        """
+        data_dict = next(data_generator)
+        data = data_dict['data']
+        target = data_dict['target']
+
+        data = maybe_to_torch(data)
+        target = maybe_to_torch(target)
+
+        if torch.cuda.is_available():
+            data = to_cuda(data)
+            target = to_cuda(target)
+
+        self.optimizer.zero_grad()
+
+        if self.fp16:
+            with autocast():
+                output = self.network(data)
+                if do_backprop:
+                    l = self.compute_loss(data, output, target)
+                else:
+                    l = self.loss(output, target)
+                del data
+
+            if do_backprop:
+                self.amp_grad_scaler.scale(l).backward()
+                self.amp_grad_scaler.unscale_(self.optimizer)
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.amp_grad_scaler.step(self.optimizer)
+                self.amp_grad_scaler.update()
+        else:
+            output = self.network(data)
+            if do_backprop:
+                l = self.compute_loss(data, output, target)
+            else:
+                l = self.loss(output, target)
+            del data
+
+            if do_backprop:
+                l.backward()
+                torch.nn.utils.clip_grad_norm_(self.network.parameters(), 12)
+                self.optimizer.step()
+
+        if run_online_evaluation:
+            self.run_online_evaluation(output, target)
+
+        del target
+
+        return l.detach().cpu().numpy()
@@ -0,0 +1,720 @@
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import List, Optional, Sequence, Tuple, Union
+
+import nnunet
+import numpy as np
+import SimpleITK as sitk
+import torch
+from image_io import ImageGeometry, resample_to_geometry
+from network_export import (exported_network_path, fold_folder,
+                            load_exported_network)
+from nnunet.inference.segmentation_export import \
+    save_segmentation_nifti_from_softmax
+from nnunet.network_architecture.generic_UNet import Generic_UNet
+from nnunet.postprocessing.connected_components import (
+    load_postprocessing, load_remove_save,
+    remove_all_but_the_largest_connected_component)
+from nnunet.preprocessing.cropping import ImageCropper
+from nnunet.preprocessing.preprocessing import (get_do_separate_z,
+                                                get_lowres_axis,
+                                                resample_data_or_seg)
+from nnunet.training.model_restore import (load_model_and_checkpoint_files,
+                                           recursive_find_python_class,
+                                           restore_model)
+from probability_map import gland_bounding_box, write_probability_map
+from sliding_window import RunFunction, SlidingWindowInference
+from weight_store import assign_weights, load_weight_store, weight_store_path
+
+
+def flipped_fraction(seg: np.ndarray, new_seg: np.ndarray) -> float:
+    """Fraction of voxels with a different label, relative to the foreground of either segmentation"""
+    foreground = np.sum((seg > 0) | (new_seg > 0))
+    return float(np.sum(seg != new_seg) / max(foreground, 1))
+
+
+def postprocess_segmentation(seg: np.ndarray, spacing: Sequence[float], for_which_classes: Optional[list] = None,
+                             min_valid_obj_size: Optional[dict] = None) -> np.ndarray:
+    """Apply nnU-Net's postprocessing (removal of all but the largest connected component)"""
+    if for_which_classes is None:
+        return seg
+    volume_per_voxel = float(np.prod(spacing, dtype=np.float64))
+    seg, _, _ = remove_all_but_the_largest_connected_component(
+        seg, for_which_classes, volume_per_voxel, min_valid_obj_size
+    )
+    return seg
+
+
+def export_segmentation(
+    softmax: np.ndarray,
+    properties: dict,
+    for_which_classes: Optional[list] = None,
+    min_valid_obj_size: Optional[dict] = None,
+    threshold: Optional[float] = None,
+    npz_file: Optional[str] = None,
+    probability_file: Optional[str] = None,
+    probability_dtype: str = "uint8",
+) -> sitk.Image:
+    """
+    Resample softmax to the input grid, binarize and postprocess, equivalent to
+    save_segmentation_nifti_from_softmax followed by nnU-Net's postprocessing.
+    Binarization is done with argmax, or with a threshold on the foreground probability
+    (two classes only). With a probability file, the foreground probability within the
+    bounding box of the segmentation is stored as well (see probability_map.py).
+    """
+    shape_after_cropping = properties['size_after_cropping']
+    shape_before_cropping = properties['original_size_of_raw_data']
+
+    # resample softmax to the spacing of the input
+    if np.any(np.array(softmax.shape[1:]) != np.array(shape_after_cropping)):
+        if get_do_separate_z(properties['original_spacing']):
+            do_separate_z, lowres_axis = True, get_lowres_axis(properties['original_spacing'])
+        elif get_do_separate_z(properties['spacing_after_resampling']):
+            do_separate_z, lowres_axis = True, get_lowres_axis(properties['spacing_after_resampling'])
+        else:
+            do_separate_z, lowres_axis = False, None
+        if lowres_axis is not None and len(lowres_axis) != 1:
+            do_separate_z = False
+        softmax = resample_data_or_seg(softmax, shape_after_cropping, is_seg=False, axis=lowres_axis,
+                                       order=1, do_separate_z=do_separate_z, order_z=0)
+
+    if npz_file is not None:
+        np.savez_compressed(npz_file, softmax=softmax.astype(np.float16))
+
+    # binarize and revert cropping
+    if threshold is None:
+        seg_cropped = softmax.argmax(0)
+    else:
+        if softmax.shape[0] != 2:
+            raise ValueError("Thresholding requires a softmax with two classes")
+        seg_cropped = (softmax[1] >= threshold).astype(np.uint8)
+    seg = np.zeros(shape_before_cropping, dtype=np.uint8)
+    bbox = properties['crop_bbox']
+    seg[tuple(slice(b[0], b[0] + s) for b, s in zip(bbox, seg_cropped.shape))] = seg_cropped
+
+    # apply postprocessing
+    seg = postprocess_segmentation(seg, properties['itk_spacing'], for_which_classes, min_valid_obj_size)
+
+    if probability_file is not None:
+        # foreground probability within the gland bounding box only, background outside the crop
+        gland_bbox = gland_bounding_box(seg, properties['itk_spacing'])
+        probabilities = np.zeros([s.stop - s.start for s in gland_bbox], dtype=np.float32)
+        start = [max(g.start, b[0]) for g, b in zip(gland_bbox, bbox)]
+        end = [min(g.stop, b[0] + s) for g, b, s in zip(gland_bbox, bbox, seg_cropped.shape)]
+        if all(s < e for s, e in zip(start, end)):
+            probabilities[tuple(slice(s - g.start, e - g.start) for s, e, g in zip(start, end, gland_bbox))] = \
+                1 - softmax[0][tuple(slice(s - b[0], e - b[0]) for s, e, b in zip(start, end, bbox))]
+        write_probability_map(probability_file, probabilities, gland_bbox, spacing=properties['itk_spacing'],
+                              origin=properties['itk_origin'], direction=properties['itk_direction'],
+                              dtype=probability_dtype)
+
+    pred: sitk.Image = sitk.GetImageFromArray(seg.astype(np.uint8))
+    pred.SetSpacing(properties['itk_spacing'])
+    pred.SetOrigin(properties['itk_origin'])
+    pred.SetDirection(properties['itk_direction'])
+    return pred
+
+
+def restore_trainer(model_folder: Path, fold: Union[int, str], checkpoint: str = "model_final_checkpoint",
+                    mixed_precision: bool = True):
+    """
+    Restore the trainer (plans and network architecture) from the .model.pkl of a fold, as
+    load_model_and_checkpoint_files, but without loading the checkpoints (for exported networks)
+    """
+    trainer = restore_model(str(fold_folder(model_folder, fold) / f"{checkpoint}.model.pkl"), fp16=mixed_precision)
+    trainer.output_folder = str(model_folder)
+    trainer.output_folder_base = str(model_folder)
+    trainer.update_fold(0)
+    trainer.initialize(False)
+    return trainer
+
+
+class EnsemblePredictor:
+    """
+    In-process replacement for `nnUNet_predict`: the trainer, plans and the
+    weights of each fold are loaded once and kept resident, such that
+    subsequent cases only pay for the actual inference.
+
+    The `torch` engine runs the networks in eager PyTorch, the `torchscript` and `onnx`
+    engines run networks exported with network_export.py. All engines use the same
+    sliding window (equivalent to nnU-Net's), with mirrored variants and patches
+    stacked into batched forward passes.
+    """
+
+    def __init__(
+        self,
+        model_folder: Path,
+        folds: Sequence[Union[int, str]] = (0, 1, 2, 3, 4),
+        checkpoint: str = "model_final_checkpoint",
+        mixed_precision: bool = True,
+        engine: str = "torch",
+        adaptive_tolerance: Optional[float] = None,
+        min_folds: int = 2,
+        memory_budget: float = 2048,
+        mirror_axes: Optional[Sequence[int]] = None,
+        cascade: bool = False,
+        cascade_margin: float = 10.0,
+        accumulator_dtype: str = "float32",
+        aggregation_budget: Optional[float] = None,
+        use_weight_store: bool = False,
+        num_threads: int = 0,
+    ):
+        self.model_folder = Path(model_folder)
+        self.folds = list(folds)
+        self.mixed_precision = mixed_precision
+        self.engine = engine
+
+        # the softmax of each fold is added to a single running accumulator (float32 or float16),
+        # and the accumulator and sliding-window aggregation buffers are limited to the aggregation
+        # budget (MB), see aggregation_budget_for and split_cases
+        self.accumulator_dtype = np.dtype(accumulator_dtype)
+        self.aggregation_budget = aggregation_budget
+
+        # adaptive ensemble: stop adding folds once the segmentation is stable (see predict_softmax)
+        self.adaptive_tolerance = adaptive_tolerance
+        self.min_folds = min_folds
+        self.num_folds_used = None
+
+        # coarse-to-fine cascade: locate the gland with a single patch of the first fold, and run
+        # the ensemble only on the gland bounding box plus margin (mm), see locate_roi
+        self.cascade = cascade
+        self.cascade_margin = cascade_margin
+        self.cascade_min_voxels = 100
+        self.cascade_max_uncertainty = 0.5
+        self.last_roi = None
+
+        # load plans and checkpoints of all folds, from the memory-mapped weight store
+        # (see weight_store.py) or from the pickled checkpoints. Exported networks contain
+        # their weights, so only the plans are restored for the other engines.
+        self.weights_mapped = use_weight_store
+        if use_weight_store:
+            self.trainer, state_dicts = load_weight_store(
+                weight_store_path(self.model_folder, checkpoint), folds=self.folds, mixed_precision=mixed_precision
+            )
+            params = []
+        elif engine != "torch":
+            self.trainer = restore_trainer(self.model_folder, self.folds[0], checkpoint=checkpoint,
+                                           mixed_precision=mixed_precision)
+            params = []
+        else:
+            self.trainer, params = load_model_and_checkpoint_files(
+                str(self.model_folder), folds=self.folds,
+                mixed_precision=mixed_precision, checkpoint_name=checkpoint
+            )
+
+        # instantiate one network per fold, so weights are not swapped for each case. Each fold
+        # gets a newly built network (the first fold the trainer's own), instead of a copy of the
+        # trainer's network, such that no copy of the (random or last loaded) weights stays resident.
+        self.networks = []
+        self.exported_networks = []
+        if engine == "torch":
+            for i in range(len(self.folds)):
+                if i > 0:
+                    self.trainer.initialize_network()
+                if use_weight_store:
+                    assign_weights(self.trainer.network, state_dicts[i])
+                else:
+                    self.trainer.load_checkpoint_ram(params[i], False)
+                self.trainer.network.eval()
+                self.networks.append(self.trainer.network)
+            self.trainer.network = self.networks[0]
+        else:
+            self.exported_networks = [
+                load_exported_network(exported_network_path(self.model_folder, fold, checkpoint, engine), engine,
+                                      num_threads=num_threads)
+                for fold in self.folds
+            ]
+            # exported networks contain their weights, the (randomly initialised) network is not used
+            self.trainer.network = None
+        del params
+
+        self.sliding_window = SlidingWindowInference(
+            patch_size=self.trainer.patch_size,
+            num_classes=self.trainer.num_classes,
+            mirror_axes=self.trainer.data_aug_params['mirror_axes'] if mirror_axes is None else mirror_axes,
+        )
+
+        # number of patches (including mirrored variants) per forward pass, within the memory budget (MB)
+        self.batch_size = self.estimate_batch_size(memory_budget)
+
+        # postprocessing as determined by nnUNet_find_best_configuration
+        self.for_which_classes, self.min_valid_obj_size = None, None
+        pp_file = self.model_folder / "postprocessing.json"
+        if pp_file.exists():
+            self.for_which_classes, self.min_valid_obj_size = load_postprocessing(str(pp_file))
+
+        # preprocessor for in-memory inputs, equivalent to trainer.preprocess_patient
+        preprocessor_name = self.trainer.plans.get('preprocessor_name', "GenericPreprocessor")
+        preprocessor_class = recursive_find_python_class(
+            [os.path.join(nnunet.__path__[0], "preprocessing")], preprocessor_name,
+            current_module="nnunet.preprocessing"
+        )
+        self.preprocessor = preprocessor_class(
+            self.trainer.normalization_schemes, self.trainer.use_mask_for_norm,
+            self.trainer.transpose_forward, self.trainer.intensity_properties
+        )
+        self.target_spacing = self.trainer.plans['plans_per_stage'][self.trainer.stage]['current_spacing']
+
+    def share_memory(self) -> None:
+        """
+        Move the weights of all folds to shared memory, such that processes forked afterwards
+        use the same copy of the weights (instead of copy-on-write pages). Weights mapped from
+        the weight store are shared through the page cache already.
+        """
+        if self.weights_mapped:
+            return
+        for network in self.networks:
+            network.share_memory()
+
+    def estimate_batch_size(self, memory_budget: float, max_batch_size: int = 32) -> int:
+        """
+        Largest batch size for which the feature maps of the network (approximated as during
+        nnU-Net's planning, in float32) fit in the memory budget (MB)
+        """
+        stage_plans = self.trainer.plans['plans_per_stage'][self.trainer.stage]
+        num_elements = Generic_UNet.compute_approx_vram_consumption(
+            self.trainer.patch_size, stage_plans['num_pool_per_axis'], self.trainer.base_num_features,
+            Generic_UNet.MAX_NUM_FILTERS_3D, self.trainer.num_input_channels, self.trainer.num_classes,
+            self.trainer.net_num_pool_op_kernel_sizes, conv_per_stage=self.trainer.conv_per_stage,
+        )
+        bytes_per_sample = 4 * int(num_elements)
+        return int(np.clip(memory_budget * 1024**2 // bytes_per_sample, 1, max_batch_size))
+
+    def aggregation_budget_for(self, shapes: Sequence[Sequence[int]], roi: bool = False) -> Optional[float]:
+        """
+        Memory budget (MB) left for the sliding-window aggregation buffers of cases of the specified
+        spatial shapes, next to the running accumulators of the cases (and, when predicting a region
+        of interest, the softmax of the full shape it is pasted into)
+        """
+        if self.aggregation_budget is None:
+            return None
+        accumulator_nbytes = sum(
+            self.trainer.num_classes * int(np.prod(shape)) * self.accumulator_dtype.itemsize for shape in shapes
+        )
+        if roi:
+            accumulator_nbytes *= 2
+        return self.aggregation_budget - accumulator_nbytes / 1024**2
+
+    def split_cases(self, shapes: Sequence[Sequence[int]]) -> List[List[int]]:
+        """
+        Groups of consecutive cases (indices) that are predicted together: as many cases as fit in the
+        aggregation budget with float16 aggregation buffers, and at least one case per group
+        """
+        if self.aggregation_budget is None:
+            return [list(range(len(shapes)))]
+        groups: List[List[int]] = []
+        for i, shape in enumerate(shapes):
+            if groups:
+                group_shapes = [shapes[j] for j in groups[-1]] + [shape]
+                nbytes = self.sliding_window.aggregation_nbytes(group_shapes, np.float16)
+                if nbytes <= self.aggregation_budget_for(group_shapes) * 1024**2:
+                    groups[-1].append(i)
+                    continue
+            groups.append([i])
+        return groups
+
+    def predict_softmax(self, data: np.ndarray, do_tta: bool = True, step_size: float = 0.5,
+                        fold_softmax_store=None, case_id: Optional[str] = None) -> np.ndarray:
+        """
+        Average the softmax predictions of all folds for preprocessed data. With a FoldSoftmaxStore,
+        the softmax of each fold is stored as well (see softmax_store.py).
+
+        Adaptive ensemble (adaptive_tolerance is not None): folds are added one after another, until
+        adding a fold changes the segmentation of the running ensemble by at most adaptive_tolerance
+        (fraction of flipped voxels, relative to the foreground), with at least min_folds folds. The
+        number of folds used is available as num_folds_used.
+        """
+        softmax: Optional[np.ndarray] = None
+        seg: Optional[np.ndarray] = None
+        self.num_folds_used = len(self.folds)
+        self.last_roi = self.locate_roi(data) if self.cascade else None
+        for i in range(len(self.folds)):
+            fold_softmax = self.predict_fold_softmax(i, data, do_tta=do_tta, step_size=step_size, roi=self.last_roi)
+            if fold_softmax_store is not None:
+                fold_softmax_store.write_fold_softmax(case_id, self.folds[i], self.transpose_backward(fold_softmax))
+            if softmax is None:
+                softmax = fold_softmax.astype(self.accumulator_dtype, copy=False)
+            else:
+                softmax += fold_softmax
+            del fold_softmax
+
+            if self.adaptive_tolerance is not None and i + 1 < len(self.folds):
+                new_seg = softmax.argmax(0)
+                if seg is not None and i + 1 >= self.min_folds and \
+                        flipped_fraction(seg, new_seg) <= self.adaptive_tolerance:
+                    self.num_folds_used = i + 1
+                    break
+                seg = new_seg
+        softmax /= self.num_folds_used
+
+        return self.transpose_backward(softmax)
+
+    def transpose_backward(self, softmax: np.ndarray) -> np.ndarray:
+        """Transpose softmax back to the axis order of the input"""
+        transpose_backward = self.trainer.plans.get('transpose_backward')
+        if transpose_backward is not None:
+            softmax = softmax.transpose([0] + [i + 1 for i in transpose_backward])
+        return softmax
+
+    def predict_fold_softmax(self, i: int, data: np.ndarray, do_tta: bool = True,
+                             step_size: float = 0.5, roi: Optional[Tuple[slice, ...]] = None) -> np.ndarray:
+        """
+        Softmax prediction of the i-th loaded fold for preprocessed data. With a region of interest
+        (spatial slicer), only the region is predicted, and the remainder is set to background.
+        """
+        if roi is None:
+            return self.sliding_window.predict(
+                self.fold_run_function(i), data, do_mirroring=do_tta, step_size=step_size, batch_size=self.batch_size,
+                aggregation_budget=self.aggregation_budget_for([data.shape[1:]]),
+            )
+
+        roi_data = data[(slice(None),) + roi]
+        roi_softmax = self.sliding_window.predict(
+            self.fold_run_function(i), roi_data, do_mirroring=do_tta, step_size=step_size, batch_size=self.batch_size,
+            aggregation_budget=self.aggregation_budget_for([data.shape[1:]], roi=True),
+        )
+        softmax = np.zeros((self.trainer.num_classes,) + data.shape[1:], dtype=roi_softmax.dtype)
+        softmax[0] = 1
+        softmax[(slice(None),) + roi] = roi_softmax
+        return softmax
+
+    def locate_roi(self, data: np.ndarray) -> Optional[Tuple[slice, ...]]:
+        """
+        Coarse pass of the cascade: segment the centre patch with the first fold (without mirroring),
+        and return the bounding box of the gland plus margin, grown to at least one patch. Returns
+        None (full coverage) when the coarse pass is uncertain: no gland found, many voxels with
+        intermediate probability, or the gland extends beyond the centre patch.
+        """
+        patch_size = np.array(self.sliding_window.patch_size)
+        shape = np.array(data.shape[1:])
+        start = np.maximum((shape - patch_size) // 2, 0)
+        end = np.minimum(start + patch_size, shape)
+        centre = tuple(slice(int(s), int(e)) for s, e in zip(start, end))
+        probabilities = self.sliding_window.predict(
+            self.fold_run_function(0), data[(slice(None),) + centre], do_mirroring=False, step_size=1
+        )
+        foreground = 1 - probabilities[0]
+
+        mask = foreground > 0.5
+        if mask.sum() < self.cascade_min_voxels:
+            return None
+        uncertain = np.sum((foreground > 0.1) & (foreground < 0.9))
+        if uncertain > self.cascade_max_uncertainty * mask.sum():
+            return None
+
+        coords = np.argwhere(mask)
+        bbox_start, bbox_end = coords.min(0), coords.max(0) + 1
+        touches_border = ((bbox_start == 0) & (start > 0)) | ((bbox_end == end - start) & (end < shape))
+        if np.any(touches_border):
+            return None
+
+        # bounding box in data coordinates, plus margin (target spacing is in the axis order of the data)
+        margin = np.ceil(self.cascade_margin / np.array(self.target_spacing)).astype(int)
+        roi_start = np.maximum(start + bbox_start - margin, 0)
+        roi_end = np.minimum(start + bbox_end + margin, shape)
+
+        # grow to at least one patch (within the data), such that windows see image context instead of padding
+        size = np.maximum(roi_end - roi_start, np.minimum(patch_size, shape))
+        roi_start = np.clip((roi_start + roi_end - size) // 2, 0, shape - size)
+        roi_end = roi_start + size
+        if np.all(roi_end - roi_start == shape):
+            return None
+        return tuple(slice(int(s), int(e)) for s, e in zip(roi_start, roi_end))
+
+    def fold_run_function(self, i: int) -> RunFunction:
+        """Function that maps a batch of patches to logits, for the i-th loaded fold"""
+        if self.engine != "torch":
+            return self.exported_networks[i]
+
+        network = self.networks[i]
+        network.do_ds = False
+        device = next(network.parameters()).device
+
+        def run(x: np.ndarray) -> np.ndarray:
+            with torch.no_grad(), torch.autocast(device.type, enabled=self.mixed_precision and device.type == "cuda"):
+                return network(torch.from_numpy(x).to(device)).float().cpu().numpy()
+
+        return run
+
+    def predict_softmax_batch(self, datas: List[np.ndarray], do_tta: bool = True,
+                              step_size: float = 0.5) -> List[np.ndarray]:
+        """
+        Average the softmax predictions of all folds for multiple preprocessed cases. For each
+        fold, the (mirrored) patches of all cases are run through the network in batches. With
+        the cascade, only the region of interest of each case is predicted (see locate_roi). With an
+        aggregation budget, the cases are predicted in groups that fit in the budget (see split_cases).
+        """
+        rois = [self.locate_roi(data) if self.cascade else None for data in datas]
+        roi_datas = [data if roi is None else data[(slice(None),) + roi] for data, roi in zip(datas, rois)]
+
+        softmaxes: List[Optional[np.ndarray]] = [None] * len(datas)
+        for group in self.split_cases([data.shape[1:] for data in roi_datas]):
+            group_datas = [roi_datas[j] for j in group]
+            aggregation_budget = self.aggregation_budget_for([data.shape[1:] for data in group_datas])
+            for i in range(len(self.folds)):
+                fold_softmaxes = self.sliding_window.predict_many(
+                    self.fold_run_function(i), group_datas, do_mirroring=do_tta, step_size=step_size,
+                    batch_size=self.batch_size, aggregation_budget=aggregation_budget,
+                )
+                for j, fold_softmax in zip(group, fold_softmaxes):
+                    if softmaxes[j] is None:
+                        softmaxes[j] = fold_softmax.astype(self.accumulator_dtype, copy=False)
+                    else:
+                        softmaxes[j] += fold_softmax
+                del fold_softmaxes, fold_softmax
+
+        results = []
+        for data, roi, softmax in zip(datas, rois, softmaxes):
+            softmax /= len(self.folds)
+            if roi is not None:
+                # outside the region of interest is background
+                full_softmax = np.zeros((self.trainer.num_classes,) + data.shape[1:], dtype=softmax.dtype)
+                full_softmax[0] = 1
+                full_softmax[(slice(None),) + roi] = softmax
+                softmax = full_softmax
+            results.append(self.transpose_backward(softmax))
+        return results
+
+    def predict_case(
+        self,
+        input_files: List[str],
+        output_file: str,
+        do_tta: bool = True,
+        step_size: float = 0.5,
+        save_npz: bool = False,
+        fold_softmax_store=None,
+    ) -> None:
+        """Segment a single case in nnUNet Raw Data Archive format, equivalent to nnUNet_predict"""
+        data, _, properties = self.trainer.preprocess_patient(input_files)
+        case_id = os.path.basename(output_file)[:-len(".nii.gz")]
+        if fold_softmax_store is not None:
+            fold_softmax_store.write_properties(case_id, properties)
+        softmax = self.predict_softmax(data, do_tta=do_tta, step_size=step_size,
+                                       fold_softmax_store=fold_softmax_store, case_id=case_id)
+
+        npz_file = output_file[:-len(".nii.gz")] + ".npz" if save_npz else None
+        save_segmentation_nifti_from_softmax(
+            softmax, output_file, properties, order=1, region_class_order=None,
+            resampled_npz_fname=npz_file, force_separate_z=None, interpolation_order_z=0,
+        )
+
+        # apply postprocessing
+        if self.for_which_classes is not None:
+            load_remove_save(output_file, output_file, self.for_which_classes, self.min_valid_obj_size)
+
+    def preprocess_images(self, images: List[sitk.Image]) -> Tuple[np.ndarray, dict]:
+        """
+        Crop, resample and normalise in-memory scans, equivalent to trainer.preprocess_patient
+        for the same scans stored in nnUNet Raw Data Archive format
+        """
+        reference = images[0]
+        properties = OrderedDict()
+        properties["original_size_of_raw_data"] = np.array(reference.GetSize())[[2, 1, 0]]
+        properties["original_spacing"] = np.array(reference.GetSpacing())[[2, 1, 0]]
+        properties["list_of_data_files"] = None
+        properties["seg_file"] = None
+        properties["itk_origin"] = reference.GetOrigin()
+        properties["itk_spacing"] = reference.GetSpacing()
+        properties["itk_direction"] = reference.GetDirection()
+
+        data = np.vstack([sitk.GetArrayFromImage(img)[None] for img in images]).astype(np.float32)
+        data, seg, properties = ImageCropper.crop(data, properties, seg=None)
+
+        transpose_forward = self.preprocessor.transpose_forward
+        data = data.transpose((0, *[i + 1 for i in transpose_forward]))
+        seg = seg.transpose((0, *[i + 1 for i in transpose_forward]))
+        data, _, properties = self.preprocessor.resample_and_normalize(
+            data, self.target_spacing, properties, seg, force_separate_z=None
+        )
+        return data.astype(np.float32), properties
+
+    def export_segmentation(
+        self,
+        softmax: np.ndarray,
+        properties: dict,
+        npz_file: Optional[str] = None,
+        probability_file: Optional[str] = None,
+        probability_dtype: str = "uint8",
+    ) -> sitk.Image:
+        """
+        Resample softmax to the input grid, binarize and postprocess, equivalent to
+        save_segmentation_nifti_from_softmax followed by nnU-Net's postprocessing
+        """
+        return export_segmentation(softmax, properties, for_which_classes=self.for_which_classes,
+                                   min_valid_obj_size=self.min_valid_obj_size, npz_file=npz_file,
+                                   probability_file=probability_file, probability_dtype=probability_dtype)
+
+    def predict_images(
+        self,
+        images: List[sitk.Image],
+        do_tta: bool = True,
+        step_size: float = 0.5,
+        npz_file: Optional[str] = None,
+        fold_softmax_store=None,
+        case_id: Optional[str] = None,
+        probability_file: Optional[str] = None,
+        probability_dtype: str = "uint8",
+    ) -> sitk.Image:
+        """Segment in-memory scans (T2W, ADC, HBV), without intermediate files"""
+        data, properties = self.preprocess_images(images)
+        if fold_softmax_store is not None:
+            fold_softmax_store.write_properties(case_id, properties)
+        softmax = self.predict_softmax(data, do_tta=do_tta, step_size=step_size,
+                                       fold_softmax_store=fold_softmax_store, case_id=case_id)
+        return self.export_segmentation(softmax, properties, npz_file=npz_file, probability_file=probability_file,
+                                        probability_dtype=probability_dtype)
+
+    def network_geometry(self, roi_geometry: ImageGeometry, spacing_factor: float = 1.0) -> ImageGeometry:
+        """
+        Grid with the target spacing of the plans, covering the same physical extent
+        as the region of interest (edges aligned, as with nnU-Net's resampling). With a
+        spacing factor, the in-plane spacing is coarsened (up to the through-plane spacing).
+        """
+        # target spacing in (z, y, x) order of the input
+        target_spacing = np.array(self.target_spacing)
+        transpose_backward = self.trainer.plans.get('transpose_backward')
+        if transpose_backward is not None:
+            target_spacing = target_spacing[transpose_backward]
+        spacing = target_spacing[::-1]
+        if spacing_factor != 1.0:
+            spacing = np.where(spacing < spacing.max(), np.minimum(spacing * spacing_factor, spacing.max()), spacing)
+
+        extent = np.array(roi_geometry.size) * np.array(roi_geometry.spacing)
+        size = np.maximum(np.round(extent / spacing), 1).astype(int)
+
+        # shift origin from centre of first input voxel to centre of first network voxel
+        direction = np.array(roi_geometry.direction).reshape(3, 3)
+        origin = np.array(roi_geometry.origin) + direction @ ((spacing - np.array(roi_geometry.spacing)) / 2)
+
+        return ImageGeometry(
+            size=tuple(int(i) for i in size),
+            spacing=tuple(float(i) for i in spacing),
+            origin=tuple(float(i) for i in origin),
+            direction=roi_geometry.direction,
+        )
+
+    def normalize(self, data: np.ndarray, nonzero_mask: np.ndarray) -> np.ndarray:
+        """Intensity normalisation per channel, equivalent to GenericPreprocessor.resample_and_normalize"""
+        normalization_schemes = self.trainer.normalization_schemes
+        use_mask_for_norm = self.trainer.use_mask_for_norm
+        intensity_properties = self.trainer.intensity_properties
+
+        for c in range(len(data)):
+            scheme = normalization_schemes[c]
+            if scheme == "CT":
+                lower_bound = intensity_properties[c]['percentile_00_5']
+                upper_bound = intensity_properties[c]['percentile_99_5']
+                data[c] = np.clip(data[c], lower_bound, upper_bound)
+                data[c] = (data[c] - intensity_properties[c]['mean']) / intensity_properties[c]['sd']
+                if use_mask_for_norm[c]:
+                    data[c][~nonzero_mask] = 0
+            elif scheme == "CT2":
+                lower_bound = intensity_properties[c]['percentile_00_5']
+                upper_bound = intensity_properties[c]['percentile_99_5']
+                mask = (data[c] > lower_bound) & (data[c] < upper_bound)
+                data[c] = np.clip(data[c], lower_bound, upper_bound)
+                data[c] = (data[c] - data[c][mask].mean()) / data[c][mask].std()
+                if use_mask_for_norm[c]:
+                    data[c][~nonzero_mask] = 0
+            elif scheme == "noNorm":
+                pass
+            elif use_mask_for_norm[c]:
+                values = data[c][nonzero_mask]
+                data[c][nonzero_mask] = (values - values.mean()) / (values.std() + 1e-8)
+                data[c][~nonzero_mask] = 0
+            else:
+                data[c] = (data[c] - data[c].mean()) / (data[c].std() + 1e-8)
+        return data
+
+    def postprocess_segmentation(self, seg: np.ndarray, spacing: Sequence[float]) -> np.ndarray:
+        """Apply nnU-Net's postprocessing (removal of all but the largest connected component)"""
+        return postprocess_segmentation(seg, spacing, self.for_which_classes, self.min_valid_obj_size)
+
+    def resample_to_network(self, images: List[sitk.Image], network_geometry: ImageGeometry) -> np.ndarray:
+        """Resample each sequence onto the network grid and normalise, returns data in the axis order of the network"""
+        data = np.stack([
+            sitk.GetArrayFromImage(resample_to_geometry(
+                sitk.Cast(image, sitk.sitkFloat32), network_geometry, interpolator=sitk.sitkBSpline
+            ))
+            for image in images
+        ]).astype(np.float32)
+
+        # intensity normalisation, with the mask of voxels covered by any sequence
+        nonzero_mask = np.any(data != 0, axis=0)
+        data = self.normalize(data, nonzero_mask)
+
+        transpose_forward = self.preprocessor.transpose_forward
+        return data.transpose((0, *[i + 1 for i in transpose_forward]))
+
+    def predict_preview(
+        self,
+        images: List[sitk.Image],
+        roi_geometry: ImageGeometry,
+        spacing_factor: float = 2.0,
+    ) -> sitk.Image:
+        """
+        Quick, low-resolution segmentation of scans (T2W, ADC, HBV): the first fold only, without
+        test-time augmentation or patch overlap, on a grid with coarser in-plane spacing. The mask
+        is returned on that coarse grid (covering the region of interest).
+        """
+        network_geometry = self.network_geometry(roi_geometry, spacing_factor=spacing_factor)
+        data = self.resample_to_network(images, network_geometry)
+        softmax = self.transpose_backward(self.predict_fold_softmax(0, data, do_tta=False, step_size=1))
+
+        seg = np.argmax(softmax, axis=0).astype(np.uint8)
+        seg = self.postprocess_segmentation(seg, spacing=network_geometry.spacing)
+
+        pred: sitk.Image = sitk.GetImageFromArray(seg)
+        pred.SetSpacing(network_geometry.spacing)
+        pred.SetOrigin(network_geometry.origin)
+        pred.SetDirection(network_geometry.direction)
+        return pred
+
+    def predict_images_fused(
+        self,
+        images: List[sitk.Image],
+        roi_geometry: ImageGeometry,
+        output_geometry: ImageGeometry,
+        do_tta: bool = True,
+        step_size: float = 0.5,
+        probability_file: Optional[str] = None,
+        probability_dtype: str = "uint8",
+    ) -> sitk.Image:
+        """
+        Segment scans (T2W, ADC, HBV) with a single resampling step in each direction: each
+        sequence is resampled from its original grid directly onto the network grid (target
+        spacing of the plans, covering the region of interest), and the softmax is resampled
+        directly onto the output grid. Scans do not need to be aligned or cropped beforehand.
+        """
+        network_geometry = self.network_geometry(roi_geometry)
+        data = self.resample_to_network(images, network_geometry)
+
+        # perform inference
+        softmax = self.predict_softmax(data, do_tta=do_tta, step_size=step_size)
+
+        # resample softmax of each class onto the output grid and binarize
+        softmax_resampled = []
+        for class_softmax in softmax:
+            img = sitk.GetImageFromArray(class_softmax.astype(np.float32))
+            img.SetSpacing(network_geometry.spacing)
+            img.SetOrigin(network_geometry.origin)
+            img.SetDirection(network_geometry.direction)
+            img = resample_to_geometry(img, output_geometry, interpolator=sitk.sitkLinear)
+            softmax_resampled.append(sitk.GetArrayFromImage(img))
+        seg = np.argmax(np.stack(softmax_resampled), axis=0).astype(np.uint8)
+
+        # apply postprocessing
+        seg = self.postprocess_segmentation(seg, spacing=output_geometry.spacing)
+
+        if probability_file is not None:
+            gland_bbox = gland_bounding_box(seg, output_geometry.spacing)
+            write_probability_map(probability_file, 1 - softmax_resampled[0][gland_bbox], gland_bbox,
+                                  spacing=output_geometry.spacing, origin=output_geometry.origin,
+                                  direction=output_geometry.direction, dtype=probability_dtype)
+
+        pred: sitk.Image = sitk.GetImageFromArray(seg.astype(np.uint8))
+        pred.SetSpacing(output_geometry.spacing)
+        pred.SetOrigin(output_geometry.origin)
+        pred.SetDirection(output_geometry.direction)
+        return pred
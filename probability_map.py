@@ -0,0 +1,117 @@
+import json
+from pathlib import Path
+from typing import Sequence, Tuple, Union
+
+import numpy as np
+import SimpleITK as sitk
+
+from atomic_io import atomic_open
+
+PathLike = Union[str, Path]
+
+"""
+Compact, memory-mappable storage of the prostate probability map. The foreground probability
+is cropped to the bounding box of the segmentation (plus margin), quantized to uint8 (or stored
+as float16), and written uncompressed after a small header, such that readers can memory-map
+the voxels without a decode step.
+
+File layout:
+- magic (8 bytes): b"PROBMAP1"
+- header length (uint32, little endian)
+- header (JSON, padded with spaces such that the voxels start at a multiple of 64 bytes):
+  dtype, shape (z, y, x), scale (probability = value * scale), and the spacing, origin and
+  direction (SimpleITK order) of the cropped grid
+- voxels (C order)
+"""
+
+MAGIC = b"PROBMAP1"
+DTYPES = ("uint8", "float16")
+
+
+def gland_bounding_box(seg: np.ndarray, spacing: Sequence[float], margin: float = 5.0) -> Tuple[slice, ...]:
+    """
+    Bounding box (z, y, x) of the segmentation plus margin (mm), with spacing in (x, y, z) order.
+    Empty for an empty segmentation.
+    """
+    coords = np.argwhere(seg > 0)
+    if len(coords) == 0:
+        return tuple(slice(0, 0) for _ in seg.shape)
+    margin_voxels = np.ceil(margin / np.array(spacing)[::-1]).astype(int)
+    start = np.maximum(coords.min(0) - margin_voxels, 0)
+    end = np.minimum(coords.max(0) + 1 + margin_voxels, seg.shape)
+    return tuple(slice(int(s), int(e)) for s, e in zip(start, end))
+
+
+def write_probability_map(
+    path: PathLike,
+    probabilities: np.ndarray,
+    bbox: Tuple[slice, ...],
+    spacing: Sequence[float],
+    origin: Sequence[float],
+    direction: Sequence[float],
+    dtype: str = "uint8",
+) -> None:
+    """
+    Store the foreground probability (z, y, x) within the bounding box of the segmentation (see
+    gland_bounding_box), given only for the bounding box. The geometry (spacing, origin, direction)
+    is that of the full probability map, in SimpleITK order.
+    """
+    if dtype not in DTYPES:
+        raise ValueError(f"Unknown probability map data type: {dtype} (choose from {DTYPES})")
+    if probabilities.shape != tuple(s.stop - s.start for s in bbox):
+        raise ValueError(f"Probabilities of shape {probabilities.shape} do not match the bounding box {bbox}")
+
+    if dtype == "uint8":
+        data, scale = np.round(np.clip(probabilities, 0, 1) * 255).astype(np.uint8), 1 / 255
+    else:
+        data, scale = probabilities.astype(np.float16), 1.0
+
+    # origin of the cropped grid
+    start = np.array([s.start for s in bbox])[::-1]
+    crop_origin = np.array(origin) + np.array(direction).reshape(3, 3) @ (start * np.array(spacing))
+
+    header = json.dumps(dict(
+        dtype=dtype,
+        shape=list(data.shape),
+        scale=scale,
+        spacing=[float(s) for s in spacing],
+        origin=[float(o) for o in crop_origin],
+        direction=[float(d) for d in direction],
+    )).encode("utf-8")
+    prefix_length = len(MAGIC) + 4
+    header += b" " * (-(prefix_length + len(header)) % 64)
+
+    with atomic_open(path) as fp:
+        fp.write(MAGIC)
+        fp.write(np.array(len(header), dtype="<u4").tobytes())
+        fp.write(header)
+        fp.write(np.ascontiguousarray(data).tobytes())
+
+
+def read_header(path: PathLike) -> Tuple[dict, int]:
+    """Header of a probability map, and the offset of the voxels in bytes"""
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a probability map: {path}")
+        header_length = int(np.frombuffer(fp.read(4), dtype="<u4")[0])
+        header = json.loads(fp.read(header_length).decode("utf-8"))
+    return header, len(MAGIC) + 4 + header_length
+
+
+def read_probability_map(path: PathLike) -> Tuple[np.ndarray, dict]:
+    """Memory-mapped (read-only) voxels of a probability map (stored values, see header["scale"]) and its header"""
+    header, offset = read_header(path)
+    shape = tuple(header["shape"])
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=header["dtype"]), header
+    return np.memmap(path, dtype=header["dtype"], mode="r", offset=offset, shape=shape), header
+
+
+def probability_map_to_image(path: PathLike) -> sitk.Image:
+    """Probability map as SimpleITK image (probabilities in [0, 1])"""
+    data, header = read_probability_map(path)
+    image = sitk.GetImageFromArray(np.asarray(data, dtype=np.float32) * header["scale"])
+    image.SetSpacing(header["spacing"])
+    image.SetOrigin(header["origin"])
+    image.SetDirection(header["direction"])
+    return image
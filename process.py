@@ -1,14 +1,32 @@
+import argparse
+import json
+import multiprocessing
 import os
+import resource
 import subprocess
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import List, Optional
 
+import numpy as np
 import SimpleITK as sitk
+import torch
+from atomic_io import atomic_write_bytes
+from cpu_config import apply_cpu_config, detect_cpu_config
 from evalutils import SegmentationAlgorithm
 from evalutils.validators import (UniqueImagesValidator,
                                   UniquePathIndicesValidator)
+from image_io import (ImageCache, centre_crop_region, gland_volume, is_subgrid,
+                      paste_to_geometry, resample_to_geometry)
+from network_export import (exported_network_path, fold_folder,
+                            model_folder_path, parse_folds)
+from nnunet_predictor import EnsemblePredictor
 from picai_prep.data_utils import atomic_image_write
-from picai_prep.preprocessing import (PreprocessingSettings, Sample,
-                                      resample_to_reference_scan)
+from picai_prep.preprocessing import PreprocessingSettings, Sample
+from result_cache import ResultCache, hash_image
+from softmax_store import FoldSoftmaxStore
+from weight_store import weight_store_path
 
 
 class MissingSequenceError(Exception):
@@ -27,11 +45,57 @@ class MultipleScansSameSequencesError(Exception):
         super().__init__(message)
 
 
+# nnUNet model settings for each inference profile
+INFERENCE_PROFILES = {
+    # ensemble of the five cross-validation folds
+    "default": dict(folds="0,1,2,3,4", checkpoint="model_final_checkpoint"),
+    # single network with the averaged weights of the five folds (see model_soup.py)
+    "fast": dict(folds="0", checkpoint="model_soup"),
+    # lightweight student network, distilled from the five-fold ensemble (trained with fold "all")
+    "student": dict(trainer="nnUNetTrainerV2_Loss_FL_and_CE_distillation", folds="all",
+                    checkpoint="model_final_checkpoint"),
+}
+
+
 def strip_metadata(img: sitk.Image) -> None:
     for key in img.GetMetaDataKeys():
         img.EraseMetaData(key)
 
 
+def reset_peak_rss() -> None:
+    """Reset the peak resident set size of this process (Linux, see clear_refs in proc(5))"""
+    try:
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def peak_rss() -> float:
+    """Peak resident set size of this process in MB (since the last reset, on Linux)"""
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+# algorithm of a forked worker process (see ProstateSegmentationAlgorithm.process_worker_pool)
+_worker_algorithm = None
+
+
+def _init_worker(algorithm, num_threads: int) -> None:
+    global _worker_algorithm
+    _worker_algorithm = algorithm
+    torch.set_num_threads(num_threads)
+
+
+def _segment_case_in_worker(case_id: str) -> str:
+    _worker_algorithm.segment_case(case_id)
+    return case_id
+
+
 
 class ProstateSegmentationAlgorithm(SegmentationAlgorithm):
     """
@@ -40,7 +104,17 @@ class ProstateSegmentationAlgorithm(SegmentationAlgorithm):
     grand-challenge.org algorithm.
     """
 
-    def __init__(self):
+    def __init__(self, batch_mode: bool = False, num_prefetch_cases: int = 2,
+                 backend: str = "in_process", debug: bool = False, crop_on_read: bool = True,
+                 num_io_workers: Optional[int] = None, fused_preprocessing: bool = False, profile: str = "default",
+                 service_mode: bool = False, num_workers: int = 1, result_cache_dir: Optional[Path] = None,
+                 result_cache_size: float = 2.0, fold_softmax_dir: Optional[Path] = None,
+                 adaptive_tolerance: Optional[float] = None, memory_budget: float = 2048,
+                 latency_budget: Optional[float] = None, latency_plan_dir: Optional[Path] = None,
+                 cascade: bool = False, preview: bool = False, preview_spacing_factor: float = 2.0,
+                 accumulator_dtype: str = "float32", aggregation_budget: Optional[float] = None,
+                 store_probability_maps: bool = False, probability_map: Optional[str] = None,
+                 weight_store: bool = False):
         super().__init__(
             validators=dict(
                 input_image=(
@@ -50,27 +124,162 @@ class ProstateSegmentationAlgorithm(SegmentationAlgorithm):
             ),
         )
 
+        # thread counts of PyTorch, OpenMP, SimpleITK and the preprocessing workers, for the
+        # CPUs available to the container (cgroup quota and affinity mask, see cpu_config.py)
+        self.cpu_config = detect_cpu_config(num_workers=num_workers)
+        apply_cpu_config(self.cpu_config)
+
         # input / output paths for algorithm
         self.input_dirs = [
             "/input/images/transverse-t2-prostate-mri",
             "/input/images/transverse-adc-prostate-mri",
             "/input/images/transverse-hbv-prostate-mri",
         ]
+        self.sequence_suffixes = ["_t2w", "_adc", "_hbv"]
         self.scan_paths = []
         self.prostate_segmentation_path = Path("/output/images/transverse-whole-prostate-mri/prostate_gland.mha")
+        self.prostate_volume_path = Path("/output/prostate-volume.json")
 
         # input / output paths for nnUNet
         self.nnunet_inp_dir = Path("/opt/algorithm/nnunet/input")
         self.nnunet_out_dir = Path("/opt/algorithm/nnunet/output")
         self.nnunet_results = Path("/opt/algorithm/results")
 
+        # nnUNet model and inference settings
+        if profile not in INFERENCE_PROFILES:
+            raise ValueError(f"Unknown inference profile: {profile}")
+        self.nnunet_settings = dict(
+            task="Task2202_prostate_segmentation",
+            trainer="nnUNetTrainerV2_Loss_FL_and_CE_checkpoints",
+        )
+        self.nnunet_settings.update(INFERENCE_PROFILES[profile])
+        self.backend = backend
+        self.debug = debug
+
+        # build the networks from the memory-mapped weight store (see weight_store.py), instead
+        # of unpickling the checkpoint of each fold
+        self.weight_store = weight_store
+        if weight_store and backend != "in_process":
+            raise ValueError("The weight store requires the in_process backend")
+
+        # memory budget (MB) for the feature maps of a batched forward pass, which
+        # determines the number of (mirrored) patches per forward pass
+        self.memory_budget = memory_budget
+
+        # memory of the ensemble: data type of the running softmax accumulator, memory budget (MB)
+        # for the accumulator and sliding-window aggregation buffers, and whether nnU-Net stores
+        # the full softmax (cli backend)
+        self.accumulator_dtype = accumulator_dtype
+        self.aggregation_budget = aggregation_budget
+        self.store_probability_maps = store_probability_maps
+
+        # compact probability map (uint8 or float16, within the gland bounding box) next to
+        # the segmentation, which can be memory-mapped downstream (see probability_map.py)
+        self.probability_map = probability_map
+        if probability_map is not None and backend == "cli":
+            raise ValueError("The probability map requires the in-process backends")
+
+        # coarse-to-fine cascade: run the sliding window only on the gland bounding box
+        self.cascade = cascade
+
+        # preview: write a low-resolution segmentation (first fold, coarser in-plane spacing, no TTA)
+        # and the gland volume first, which the full-resolution ensemble replaces when finished
+        self.preview = preview
+        self.preview_spacing_factor = preview_spacing_factor
+        if preview and backend == "cli":
+            raise ValueError("The preview requires the in-process backends")
+
+        # adaptive ensemble: stop adding folds once the segmentation is stable
+        self.adaptive_tolerance = adaptive_tolerance
+        if adaptive_tolerance is not None and backend == "cli":
+            raise ValueError("The adaptive ensemble requires the in-process backends")
+
+        # in-process nnUNet predictors, loaded on first use and kept resident
+        self.predictors = {}
+
+        # access to input scans, such that no scan is read twice
+        self.image_cache = ImageCache()
+
+        # preprocessing settings: centre crop of the prostate field of view, which
+        # is read directly from disk (instead of cropping the full scans)
+        self.physical_size = [81.0, 192.0, 192.0]
+        self.crop_on_read = crop_on_read
+
+        # test-time augmentation (mirror axes, default: as in training), sliding-window step size
+        # and number of folds, which are planned to fit the latency budget (seconds per case)
+        self.mirror_axes = None
+        self.do_tta = True
+        self.step_size = 0.5
+        if latency_budget is not None:
+            if backend == "cli":
+                raise ValueError("The latency budget requires the in-process backends")
+            self.plan_inference(latency_budget, plan_dir=latency_plan_dir)
+
+        # resample scans directly onto the network grid (and back), instead of
+        # aligning with picai_prep and resampling with nnU-Net
+        self.fused_preprocessing = fused_preprocessing
+        if fused_preprocessing and backend == "cli":
+            raise ValueError("Fused preprocessing requires the in_process backend")
+
+        # crop region of the T2W scan for each case, to paste the prediction back
+        self.crop_regions = {}
+
+        # number of scans read and resampled concurrently (per case)
+        self.num_io_workers = self.cpu_config.io_workers if num_io_workers is None else num_io_workers
+
+        # batch mode settings
+        self.batch_mode = batch_mode
+        self.num_prefetch_cases = num_prefetch_cases
+
+        # number of forked worker processes (batch mode), which share the fold weights
+        self.num_workers = num_workers
+        if num_workers > 1 and not (batch_mode and backend == "in_process"):
+            raise ValueError("Multiple workers require batch mode with the in_process backend")
+
         # ensure required folders exist
         self.nnunet_inp_dir.mkdir(exist_ok=True, parents=True)
         self.nnunet_out_dir.mkdir(exist_ok=True, parents=True)
         self.prostate_segmentation_path.parent.mkdir(exist_ok=True, parents=True)
 
+        # store of previous results, keyed by the hash of the input scans and the model
+        # (result_cache_size in GB)
+        self.result_cache = None
+        if result_cache_dir is not None:
+            self.result_cache = ResultCache(result_cache_dir, max_size=int(result_cache_size * 1024**3))
+        self.model_key = None
+        self.result_keys = {}
+
+        # store the softmax of each fold for each case, to re-evaluate ensembles,
+        # thresholds and postprocessing afterwards (see softmax_store.py)
+        self.fold_softmax_store = None
+        if fold_softmax_dir is not None:
+            if backend == "cli" or fused_preprocessing:
+                raise ValueError("Storing the softmax of each fold requires the in-process backends "
+                                 "without fused preprocessing")
+            self.fold_softmax_store = FoldSoftmaxStore(fold_softmax_dir)
+            self.fold_softmax_store.write_metadata(
+                dict(**self.nnunet_settings, backend=backend),
+                postprocessing_file=self.get_model_folder() / "postprocessing.json",
+            )
+
+        # service mode: cases are submitted over HTTP (see inference_service.py)
+        self.service_mode = service_mode
+        if service_mode:
+            if backend == "cli" or fused_preprocessing:
+                raise ValueError("Service mode requires the in-process backends without fused preprocessing")
+            if adaptive_tolerance is not None:
+                raise ValueError("The adaptive ensemble is not supported in service mode (batched forward passes)")
+            if fold_softmax_dir is not None:
+                raise ValueError("Storing the softmax of each fold is not supported in service mode")
+            self.cases = {}
+            return
+
         # input validation for multiple inputs
         scan_glob_format = "*.mha"
+        if self.batch_mode:
+            self.cases = self.collect_cases(scan_glob_format=scan_glob_format)
+            return
+
         for folder in self.input_dirs:
             file_paths = list(Path(folder).glob(scan_glob_format))
             if len(file_paths) == 0:
@@ -80,64 +289,551 @@ class ProstateSegmentationAlgorithm(SegmentationAlgorithm):
             else:
                 # append scan path to algorithm input paths
                 self.scan_paths += [file_paths[0]]
+        self.cases = {"scan": self.scan_paths}
+
+    def collect_cases(self, scan_glob_format="*.mha"):
+        """
+        Pair T2W, ADC and HBV scans by case ID, which is the filename without the
+        sequence suffix (e.g., ProstateX-0000_07-07-2011 for ProstateX-0000_07-07-2011_t2w.mha)
+        """
+        scans_per_sequence = []
+        for folder, suffix in zip(self.input_dirs, self.sequence_suffixes):
+            scans = {}
+            for path in sorted(Path(folder).glob(scan_glob_format)):
+                case_id = path.name[:-len(".mha")]
+                if case_id.endswith(suffix):
+                    case_id = case_id[:-len(suffix)]
+                if case_id in scans:
+                    raise MultipleScansSameSequencesError(name=case_id, folder=folder)
+                scans[case_id] = path
+            if len(scans) == 0:
+                raise MissingSequenceError(name=folder.split("/")[-1], folder=folder)
+            scans_per_sequence.append(scans)
+
+        cases = {}
+        for case_id in sorted(scans_per_sequence[0]):
+            for folder, scans in zip(self.input_dirs, scans_per_sequence):
+                if case_id not in scans:
+                    raise MissingSequenceError(name=case_id, folder=folder)
+            cases[case_id] = [scans[case_id] for scans in scans_per_sequence]
+
+        # check for scans without T2W counterpart
+        for folder, scans in zip(self.input_dirs[1:], scans_per_sequence[1:]):
+            for case_id in scans:
+                if case_id not in cases:
+                    raise MissingSequenceError(name=case_id, folder=self.input_dirs[0])
+
+        return cases
+
+    def get_output_path(self, case_id: str) -> Path:
+        """Path to store the prostate segmentation of the specified case"""
+        if not self.batch_mode:
+            return self.prostate_segmentation_path
+        return self.prostate_segmentation_path.parent / f"{case_id}_{self.prostate_segmentation_path.name}"
+
+    def get_probability_path(self, case_id: str) -> Path:
+        """Path to store the prostate probability map of the specified case"""
+        return self.get_output_path(case_id).with_suffix(".pmap")
+
+    def get_volume_path(self, case_id: str) -> Path:
+        """Path to store the prostate volume of the specified case (preview mode)"""
+        if not self.batch_mode:
+            return self.prostate_volume_path
+        return self.prostate_volume_path.parent / f"{case_id}_{self.prostate_volume_path.name}"
+
+    def preprocess_input(self, scan_paths=None, case_id="scan"):
+        """
+        Preprocess input images for nnUNet, returns the preprocessed scans. With fused
+        preprocessing, the scans are returned as read (alignment is done by the predictor).
+        """
+        if scan_paths is None:
+            scan_paths = self.scan_paths
+
+        # record crop region of the T2W scan (read from the header)
+        t2w_region = centre_crop_region(self.image_cache.read_geometry(scan_paths[0]), self.physical_size)
+        self.crop_regions[case_id] = t2w_region
+
+        with ThreadPoolExecutor(max_workers=self.num_io_workers) as pool:
+            if self.crop_on_read:
+                # read only the field of view, scans are cropped already
+                scans = self.read_cropped_scans(scan_paths, t2w_region=t2w_region, pool=pool)
+                settings = PreprocessingSettings()
+            else:
+                scans = list(pool.map(self.image_cache.read_image, scan_paths))
+                settings = PreprocessingSettings(
+                    physical_size=self.physical_size,
+                    crop_only=True
+                )
+
+            if not self.fused_preprocessing:
+                # perform preprocessing: each Sample aligns one sequence to the T2W scan,
+                # such that ADC and HBV are resampled in parallel
+                samples = [
+                    Sample(
+                        scans=[scans[0], scan],
+                        settings=settings,
+                    )
+                    for scan in scans[1:]
+                ]
+                list(pool.map(Sample.preprocess, samples))
+                scans = [samples[0].scans[0]] + [sample.scans[1] for sample in samples]
+
+        # only the geometry of the original scans is needed from here on
+        self.image_cache.release_images(scan_paths)
+
+        # write preprocessed scans to nnUNet input directory for debugging
+        # (with fused preprocessing, these are the scans as read)
+        if self.debug:
+            self.write_nnunet_input(scans, case_id=case_id)
+
+        return scans
+
+    def read_cropped_scans(self, scan_paths, t2w_region, pool: ThreadPoolExecutor):
+        """
+        Read the centre crop of each scan, which is the region picai_prep crops (and then
+        resamples ADC and HBV from). ADC and HBV are read over exactly their own centre crop,
+        because the BSpline interpolation of the alignment depends on the whole input region.
+        """
+        geometries = list(pool.map(self.image_cache.read_geometry, scan_paths))
+        regions = [t2w_region] + [
+            centre_crop_region(geometry, self.physical_size)
+            for geometry in geometries[1:]
+        ]
+        return list(pool.map(self.image_cache.read_image, scan_paths, regions))
+
+    def write_nnunet_input(self, scans, case_id="scan", input_dir=None):
+        """Write preprocessed scans to nnUNet input directory in nnUNet Raw Data Archive format"""
+        if input_dir is None:
+            input_dir = self.nnunet_inp_dir
+        for i, scan in enumerate(scans):
+            path = Path(input_dir) / f"{case_id}_{i:04d}.nii.gz"
+            atomic_image_write(scan, path)
+
+    def postprocess_output(self, pred: sitk.Image, scan_paths=None, case_id="scan"):
+        """Transform nnUNet prediction to original space and save to output folder"""
+        if scan_paths is None:
+            scan_paths = self.scan_paths
+
+        # transform prediction to original space
+        pred = self.restore_original_space(pred, scan_paths=scan_paths, case_id=case_id)
+
+        # save prediction to output folder (replacing the preview, if any)
+        atomic_image_write(pred, str(self.get_output_path(case_id)))
+        if case_id in self.result_keys:
+            self.result_cache.put(self.result_keys.pop(case_id), self.get_output_path(case_id))
+        if self.preview:
+            self.write_volume(gland_volume(pred), case_id=case_id, preview=False)
+
+        # case is finished
+        self.image_cache.evict(scan_paths)
+
+    def write_preview(self, scans, case_id="scan", scan_paths=None):
+        """
+        Segment the preprocessed scans with the first fold of the ensemble, at a coarser in-plane
+        spacing and without TTA, and write the low-resolution mask and the gland volume
+        """
+        if scan_paths is None:
+            scan_paths = self.scan_paths
+
+        reference_geometry = self.image_cache.read_geometry(scan_paths[0])
+        predictor = self.get_predictor(**self.nnunet_settings, backend=self.backend,
+                                       adaptive_tolerance=self.adaptive_tolerance)
+        pred = predictor.predict_preview(
+            scans,
+            roi_geometry=reference_geometry.region_geometry(self.crop_regions[case_id]),
+            spacing_factor=self.preview_spacing_factor,
+        )
+        strip_metadata(pred)
+        atomic_image_write(pred, str(self.get_output_path(case_id)))
+
+        volume = gland_volume(pred)
+        self.write_volume(volume, case_id=case_id, preview=True)
+        print(f"Preview for {case_id}: prostate volume {volume:.1f} mL")
+
+    def write_volume(self, volume: float, case_id="scan", preview=False):
+        """Save the prostate volume (mL), marked as preview or final"""
+        path = self.get_volume_path(case_id)
+        atomic_write_bytes(path, json.dumps(dict(volume_ml=volume, preview=preview)).encode("utf-8"))
+
+    def restore_cached_result(self, case_id: str) -> bool:
+        """
+        Look up the result of the specified case in the result cache, and copy it to the output
+        folder if found. Returns whether the case is finished.
+        """
+        if self.result_cache is None or self.probability_map is not None or self.fold_softmax_store is not None:
+            # the result cache stores segmentations only (no probability maps or softmax of each fold)
+            return False
+
+        scan_paths = self.cases[case_id]
+
+        # the scans are hashed from the full volumes, which stay in the image cache until
+        # preprocessing is done (the field of view is cropped from memory, not read again)
+        image_hashes = [hash_image(self.image_cache.read_image(path)) for path in scan_paths]
+
+        key = ResultCache.case_key(image_hashes, self.get_model_key())
+        if self.result_cache.get(key, self.get_output_path(case_id)):
+            print(f"Found previous result for {case_id}")
+            if self.preview:
+                pred = sitk.ReadImage(str(self.get_output_path(case_id)))
+                self.write_volume(gland_volume(pred), case_id=case_id, preview=False)
+            self.image_cache.evict(scan_paths)
+            return True
+        self.result_keys[case_id] = key
+        return False
+
+    def get_model_key(self) -> str:
+        """Identity of the model and inference settings (computed once)"""
+        if self.model_key is None:
+            self.model_key = self.result_cache.model_key(self.model_files(), settings=dict(
+                **self.nnunet_settings, backend=self.backend, crop_on_read=self.crop_on_read,
+                fused_preprocessing=self.fused_preprocessing, physical_size=self.physical_size,
+                mirror_axes=self.mirror_axes, do_tta=self.do_tta, step_size=self.step_size,
+                accumulator_dtype=self.accumulator_dtype, aggregation_budget=self.aggregation_budget,
+                adaptive_tolerance=self.adaptive_tolerance, cascade=self.cascade,
+            ))
+        return self.model_key
+
+    def plan_inference(self, latency_budget: float, plan_dir: Optional[Path] = None):
+        """Select mirror axes, step size and number of folds for the latency budget (see latency_planner.py)"""
+        from latency_planner import plan_inference
+
+        setting = plan_inference(
+            model_folder=self.get_model_folder(),
+            latency_budget=latency_budget,
+            load_predictor=lambda: self.get_predictor(**self.nnunet_settings, backend=self.backend),
+            shape_fn=self.network_input_shape,
+            settings=dict(**self.nnunet_settings, backend=self.backend, memory_budget=self.memory_budget),
+            plan_dir=plan_dir,
+        )
+        self.nnunet_settings["folds"] = ",".join(self.nnunet_settings["folds"].split(",")[:setting.num_folds])
+        self.mirror_axes = setting.mirror_axes
+        self.do_tta = len(setting.mirror_axes) > 0
+        self.step_size = setting.step_size
+
+        # release the predictor used for benchmarking (with all folds)
+        self.predictors = {}
+
+    def network_input_shape(self, predictor: EnsemblePredictor) -> List[int]:
+        """Shape of the preprocessed field of view (physical_size at the target spacing)"""
+        physical_size = np.array(self.physical_size)[predictor.preprocessor.transpose_forward]
+        return [int(s) for s in np.round(physical_size / np.array(predictor.target_spacing))]
+
+    def get_model_folder(self, network="3d_fullres", plans="nnUNetPlansv2.1") -> Path:
+        """Results folder of the nnUNet model of the inference profile"""
+        settings = self.nnunet_settings
+        return model_folder_path(self.nnunet_results, task=settings["task"], trainer=settings["trainer"],
+                                 plans=plans, network=network)
+
+    def model_files(self, network="3d_fullres", plans="nnUNetPlansv2.1") -> List[Path]:
+        """
+        Files that determine the model identity: plans, postprocessing and the checkpoint of each
+        fold (or the weight store, which contains the plans and checkpoints)
+        """
+        settings = self.nnunet_settings
+        model_folder = self.get_model_folder(network=network, plans=plans)
+        files = [model_folder / "plans.pkl"]
+        if (model_folder / "postprocessing.json").exists():
+            files.append(model_folder / "postprocessing.json")
+        if self.weight_store:
+            return files[1:] + [weight_store_path(model_folder, settings["checkpoint"])]
+        for fold in settings["folds"].split(","):
+            if self.backend in ("in_process", "cli"):
+                files.append(fold_folder(model_folder, fold) / f"{settings['checkpoint']}.model")
+            else:
+                files.append(exported_network_path(model_folder, fold, settings["checkpoint"], self.backend))
+        return files
+
+    def restore_original_space(self, pred: sitk.Image, scan_paths=None, case_id="scan") -> sitk.Image:
+        """Transform nnUNet prediction to the grid of the original T2W scan"""
+        if scan_paths is None:
+            scan_paths = self.scan_paths
+
+        reference_geometry = self.image_cache.read_geometry(scan_paths[0])
+        crop_region = self.crop_regions.pop(case_id, None)
+        if is_subgrid(pred, reference_geometry, ((0, 0, 0), reference_geometry.size)):
+            # prediction is in original space already
+            pass
+        elif crop_region is not None and is_subgrid(pred, reference_geometry, crop_region):
+            # prediction grid is the crop of the T2W scan: paste back in index space
+            pred = paste_to_geometry(pred, reference_geometry, crop_region)
+        else:
+            pred = resample_to_geometry(pred, reference_geometry)
 
-    def preprocess_input(self):
-        """Preprocess input images to nnUNet Raw Data Archive format"""
-        # set up Sample
-        sample = Sample(
-            scans=[
-                sitk.ReadImage(str(path))
-                for path in self.scan_paths
-            ],
-            settings=PreprocessingSettings(
-                physical_size=[81.0, 192.0, 192.0],
-                crop_only=True
+        # remove metadata to get rid of SimpleITK warning
+        strip_metadata(pred)
+        return pred
+
+    def predict_case(self, scans, case_id="scan", scan_paths=None) -> sitk.Image:
+        """Perform inference using nnUNet, returns the binarized and postprocessed prediction"""
+        if scan_paths is None:
+            scan_paths = self.scan_paths
+        pred_path = self.nnunet_out_dir / f"{case_id}.nii.gz"
+
+        if self.fused_preprocessing:
+            # map scans onto the network grid and the prediction back in a single step each
+            reference_geometry = self.image_cache.read_geometry(scan_paths[0])
+            predictor = self.get_predictor(**self.nnunet_settings, backend=self.backend,
+                                       adaptive_tolerance=self.adaptive_tolerance)
+            pred = predictor.predict_images_fused(
+                scans,
+                roi_geometry=reference_geometry.region_geometry(self.crop_regions[case_id]),
+                output_geometry=reference_geometry,
+                do_tta=self.do_tta,
+                step_size=self.step_size,
+                **self.probability_map_settings(case_id),
             )
+            self.report_inference(predictor, case_id)
+            return pred
+
+        if self.backend == "cli":
+            # nnUNet_predict reads from and writes to disk, one folder per case
+            input_dir = self.nnunet_inp_dir / case_id
+            input_dir.mkdir(exist_ok=True)
+            self.write_nnunet_input(scans, case_id=case_id, input_dir=input_dir)
+            self.predict(**self.nnunet_settings, backend="cli", input_dir=input_dir,
+                         store_probability_maps=self.store_probability_maps)
+            return sitk.ReadImage(str(pred_path))
+
+        predictor = self.get_predictor(**self.nnunet_settings, backend=self.backend,
+                                       adaptive_tolerance=self.adaptive_tolerance)
+        pred = predictor.predict_images(
+            scans,
+            do_tta=self.do_tta,
+            step_size=self.step_size,
+            npz_file=str(self.nnunet_out_dir / f"{case_id}.npz") if self.debug else None,
+            fold_softmax_store=self.fold_softmax_store,
+            case_id=case_id,
+            **self.probability_map_settings(case_id),
         )
+        self.report_inference(predictor, case_id)
 
-        # perform preprocessing
-        sample.preprocess()
+        if self.debug:
+            atomic_image_write(pred, str(pred_path))
 
-        # write preprocessed scans to nnUNet input directory
-        for i, scan in enumerate(sample.scans):
-            path = self.nnunet_inp_dir / f"scan_{i:04d}.nii.gz"
-            atomic_image_write(scan, path)
+        return pred
+
+    def probability_map_settings(self, case_id: str) -> dict:
+        """Arguments of the predictor to store the probability map of the specified case (if enabled)"""
+        if self.probability_map is None:
+            return {}
+        return dict(probability_file=str(self.get_probability_path(case_id)), probability_dtype=self.probability_map)
+
+    def report_peak_rss(self, case_id: str):
+        """Report the peak memory of this process since the start of the case (see reset_peak_rss)"""
+        print(f"Peak RSS for {case_id}: {peak_rss():.0f} MB")
+
+    def report_inference(self, predictor: EnsemblePredictor, case_id: str):
+        """Report the number of folds used by the adaptive ensemble and the cascade ROI for the last case"""
+        if predictor.adaptive_tolerance is not None:
+            print(f"Adaptive ensemble for {case_id}: used {predictor.num_folds_used} of {len(predictor.folds)} folds")
+        if predictor.cascade:
+            roi = "full coverage" if predictor.last_roi is None else \
+                "x".join(str(s.stop - s.start) for s in predictor.last_roi) + " voxels"
+            print(f"Cascade for {case_id}: {roi}")
 
     # Note: need to overwrite process because of flexible inputs, which requires custom data loading
     def process(self):
         """
         Load bpMRI scans and segment the whole prostate gland
         """
+        if self.batch_mode and self.num_workers > 1:
+            self.process_worker_pool()
+            return
+        elif self.batch_mode:
+            self.process_batch()
+            return
+
+        # return previous result for the same scans, if any
+        if self.restore_cached_result("scan"):
+            return
+
         # perform preprocessing
-        self.preprocess_input()
+        reset_peak_rss()
+        scans = self.preprocess_input()
+
+        # write the preview, before the full-resolution ensemble
+        if self.preview:
+            self.write_preview(scans)
 
         # perform inference using nnUNet
-        self.predict(
-            task="Task2202_prostate_segmentation",
-            trainer="nnUNetTrainerV2_Loss_FL_and_CE_checkpoints",
-            checkpoint="model_final_checkpoint",
-        )
+        pred = self.predict_case(scans)
 
-        # read binarized and postprocessed prediction
-        pred_path = str(self.nnunet_out_dir / "scan.nii.gz")
-        pred: sitk.Image = sitk.ReadImage(pred_path)
+        # transform prediction to original space and save
+        self.postprocess_output(pred)
+        self.report_peak_rss("scan")
 
-        # transform prediction to original space
-        reference_scan = sitk.ReadImage(str(self.scan_paths[0]))
-        pred = resample_to_reference_scan(pred, reference_scan_original=reference_scan)
+    def process_batch(self):
+        """
+        Segment the whole prostate gland for all cases. Reading and preprocessing of
+        upcoming cases (and their previews), and writing of finished cases, runs in
+        background threads while the current case is segmented.
+        """
+        case_ids = list(self.cases)
+        if self.result_cache is not None:
+            self.get_model_key()
+        if self.preview:
+            # load the predictor before the previews of the prefetched cases use it
+            self.get_predictor(**self.nnunet_settings, backend=self.backend, adaptive_tolerance=self.adaptive_tolerance)
+        with ThreadPoolExecutor(max_workers=self.num_prefetch_cases) as preprocess_pool, \
+                ThreadPoolExecutor(max_workers=1) as postprocess_pool:
+            # start preprocessing of the first cases
+            preprocessing = deque(
+                preprocess_pool.submit(self.prepare_case, case_id)
+                for case_id in case_ids[:self.num_prefetch_cases]
+            )
+            postprocessing = []
+
+            for i, case_id in enumerate(case_ids):
+                # wait for preprocessing of the current case and queue the next one
+                scans = preprocessing.popleft().result()
+                next_idx = i + self.num_prefetch_cases
+                if next_idx < len(case_ids):
+                    preprocessing.append(preprocess_pool.submit(self.prepare_case, case_ids[next_idx]))
+                if scans is None:
+                    # previous result found in the result cache
+                    continue
+
+                # perform inference using nnUNet (peak memory includes the prefetched cases)
+                reset_peak_rss()
+                pred = self.predict_case(scans, case_id=case_id, scan_paths=self.cases[case_id])
+                self.report_peak_rss(case_id)
+
+                # transform prediction to original space and save in the background
+                postprocessing.append(postprocess_pool.submit(
+                    self.postprocess_output, pred, self.cases[case_id], case_id
+                ))
+
+            # raise exceptions from writing, if any
+            for future in postprocessing:
+                future.result()
+
+    def prepare_case(self, case_id: str):
+        """
+        Look up the result of a case of the batch in the result cache, or preprocess it otherwise
+        and write its preview (ahead of the full-resolution ensembles of the preceding cases).
+        Returns the preprocessed scans, or None if the case is finished.
+        """
+        if self.restore_cached_result(case_id):
+            return None
+        scans = self.preprocess_input(self.cases[case_id], case_id)
+        if self.preview:
+            self.write_preview(scans, case_id=case_id, scan_paths=self.cases[case_id])
+        return scans
+
+    def segment_case(self, case_id: str):
+        """Read, preprocess, segment and save a single case of the batch"""
+        if self.restore_cached_result(case_id):
+            return
+        scan_paths = self.cases[case_id]
+        reset_peak_rss()
+        scans = self.preprocess_input(scan_paths, case_id)
+        if self.preview:
+            self.write_preview(scans, case_id=case_id, scan_paths=scan_paths)
+        pred = self.predict_case(scans, case_id=case_id, scan_paths=scan_paths)
+        self.postprocess_output(pred, scan_paths, case_id)
+        self.report_peak_rss(case_id)
+
+    def process_worker_pool(self):
+        """
+        Segment all cases with forked worker processes. The weights of all folds are loaded
+        once in shared memory before forking, such that the workers map the same copy
+        (read-only) and memory does not grow with the number of workers. The CPU threads
+        are divided between the workers.
+        """
+        if torch.cuda.is_available():
+            raise RuntimeError("The worker pool is intended for CPU inference (CUDA cannot be used after fork)")
 
-        # remove metadata to get rid of SimpleITK warning
-        strip_metadata(pred)
+        predictor = self.get_predictor(**self.nnunet_settings, backend=self.backend,
+                                       adaptive_tolerance=self.adaptive_tolerance)
+        predictor.share_memory()
+        if self.result_cache is not None:
+            self.get_model_key()
 
-        # save prediction to output folder
-        atomic_image_write(pred, str(self.prostate_segmentation_path))
+        ctx = multiprocessing.get_context("fork")
+        with ctx.Pool(self.num_workers, initializer=_init_worker,
+                      initargs=(self, self.cpu_config.torch_threads)) as pool:
+            for case_id in pool.imap_unordered(_segment_case_in_worker, list(self.cases)):
+                print(f"Segmented {case_id}")
 
     def predict(self, task, trainer="nnUNetTrainerV2", network="3d_fullres",
-                checkpoint="model_final_checkpoint", folds="0,1,2,3,4", store_probability_maps=True,
-                disable_augmentation=False, disable_patch_overlap=False):
+                checkpoint="model_final_checkpoint", folds="0,1,2,3,4", store_probability_maps=False,
+                disable_augmentation=False, disable_patch_overlap=False, backend="in_process",
+                input_dir=None, output_dir=None, adaptive_tolerance=None):
+        """
+        Use trained nnUNet network to generate segmentation masks for all cases in
+        the nnUNet input directory
+
+        The `in_process` backend keeps the model of each fold loaded between calls,
+        the `torchscript`, `onnx` and `onnx_int8` (quantized) backends do the same with
+        networks exported using network_export.py, and the `cli` backend runs nnUNet_predict
+        in a subprocess.
+
+        With adaptive_tolerance, folds are added one after another until the segmentation is
+        stable (in-process backends only, see EnsemblePredictor.predict_softmax).
+        """
+        input_dir = self.nnunet_inp_dir if input_dir is None else Path(input_dir)
+        output_dir = self.nnunet_out_dir if output_dir is None else Path(output_dir)
+
+        if backend == "cli":
+            self.predict_cli(
+                task=task, trainer=trainer, network=network, checkpoint=checkpoint, folds=folds,
+                store_probability_maps=store_probability_maps, disable_augmentation=disable_augmentation,
+                disable_patch_overlap=disable_patch_overlap, input_dir=input_dir, output_dir=output_dir,
+            )
+            return
+        elif backend not in ("in_process", "torchscript", "onnx", "onnx_int8"):
+            raise ValueError(f"Unknown inference backend: {backend}")
+
+        predictor = self.get_predictor(task=task, trainer=trainer, network=network,
+                                       checkpoint=checkpoint, folds=folds, backend=backend,
+                                       adaptive_tolerance=adaptive_tolerance)
+
+        # collect input scans per case (scan_0000.nii.gz, scan_0001.nii.gz, ...)
+        case_ids = sorted(set(path.name[:-len("_0000.nii.gz")] for path in input_dir.glob("*_0000.nii.gz")))
+        for case_id in case_ids:
+            input_files = sorted(str(path) for path in input_dir.glob(f"{case_id}_[0-9][0-9][0-9][0-9].nii.gz"))
+            predictor.predict_case(
+                input_files=input_files,
+                output_file=str(output_dir / f"{case_id}.nii.gz"),
+                do_tta=not disable_augmentation,
+                step_size=1 if disable_patch_overlap else 0.5,
+                save_npz=store_probability_maps,
+                fold_softmax_store=self.fold_softmax_store,
+            )
+            self.report_inference(predictor, case_id)
+
+    def get_predictor(self, task, trainer="nnUNetTrainerV2", network="3d_fullres",
+                      checkpoint="model_final_checkpoint", folds="0,1,2,3,4", plans="nnUNetPlansv2.1",
+                      backend="in_process", adaptive_tolerance=None):
+        """Load nnUNet model (once) and return the in-process predictor"""
+        key = (task, trainer, network, checkpoint, folds, plans, backend, adaptive_tolerance)
+        if key not in self.predictors:
+            model_folder = model_folder_path(self.nnunet_results, task=task, trainer=trainer, plans=plans,
+                                             network=network)
+            self.predictors[key] = EnsemblePredictor(
+                model_folder=model_folder,
+                folds=parse_folds(folds),
+                checkpoint=checkpoint,
+                engine="torch" if backend == "in_process" else backend,
+                adaptive_tolerance=adaptive_tolerance,
+                memory_budget=self.memory_budget,
+                mirror_axes=self.mirror_axes,
+                cascade=self.cascade,
+                accumulator_dtype=self.accumulator_dtype,
+                aggregation_budget=self.aggregation_budget,
+                use_weight_store=self.weight_store,
+                num_threads=self.cpu_config.torch_threads,
+            )
+        return self.predictors[key]
+
+    def predict_cli(self, task, trainer="nnUNetTrainerV2", network="3d_fullres",
+                    checkpoint="model_final_checkpoint", folds="0,1,2,3,4", store_probability_maps=False,
+                    disable_augmentation=False, disable_patch_overlap=False, input_dir=None, output_dir=None):
         """
-        Use trained nnUNet network to generate segmentation masks
+        Use trained nnUNet network to generate segmentation masks, using nnUNet_predict
         """
+        input_dir = self.nnunet_inp_dir if input_dir is None else input_dir
+        output_dir = self.nnunet_out_dir if output_dir is None else output_dir
 
         # Set environment variables
         os.environ['RESULTS_FOLDER'] = str(self.nnunet_results)
@@ -146,12 +842,12 @@ class ProstateSegmentationAlgorithm(SegmentationAlgorithm):
         cmd = [
             'nnUNet_predict',
             '-t', task,
-            '-i', str(self.nnunet_inp_dir),
-            '-o', str(self.nnunet_out_dir),
+            '-i', str(input_dir),
+            '-o', str(output_dir),
             '-m', network,
             '-tr', trainer,
-            '--num_threads_preprocessing', '2',
-            '--num_threads_nifti_save', '1'
+            '--num_threads_preprocessing', str(self.cpu_config.preprocessing_threads),
+            '--num_threads_nifti_save', str(self.cpu_config.nifti_save_threads)
         ]
 
         if folds:
@@ -175,4 +871,90 @@ class ProstateSegmentationAlgorithm(SegmentationAlgorithm):
 
 
 if __name__ == "__main__":
-    ProstateSegmentationAlgorithm().process()
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--batch", action="store_true",
+                        help="Segment all cases in the input folders, paired by case ID")
+    parser.add_argument("--backend", choices=["in_process", "torchscript", "onnx", "onnx_int8", "cli"], default="in_process",
+                        help="Run nnU-Net in-process (eager PyTorch or exported networks), or using nnUNet_predict")
+    parser.add_argument("--debug", action="store_true",
+                        help="Write intermediate nnU-Net inputs and outputs to disk")
+    parser.add_argument("--no_crop_on_read", action="store_true",
+                        help="Read full scans and crop afterwards")
+    parser.add_argument("--fused_preprocessing", action="store_true",
+                        help="Resample scans directly onto the network grid, and the prediction back")
+    parser.add_argument("--profile", choices=list(INFERENCE_PROFILES), default="default",
+                        help="Inference profile: five-fold ensemble (default), merged network (fast) "
+                             "or distilled student network (student)")
+    parser.add_argument("--weight_store", action="store_true",
+                        help="Build the networks from the memory-mapped weight store (see weight_store.py)")
+    parser.add_argument("--num_workers", type=int, default=1,
+                        help="Number of worker processes sharing one copy of the model weights (with --batch)")
+    parser.add_argument("--result_cache", type=Path, default=None,
+                        help="Folder to store results, such that repeated studies are not segmented again")
+    parser.add_argument("--result_cache_size", type=float, default=2.0,
+                        help="Maximum size of the result cache in GB (least recently used results are evicted)")
+    parser.add_argument("--fold_softmax_store", type=Path, default=None,
+                        help="Folder to store the softmax of each fold for each case (see softmax_store.py)")
+    parser.add_argument("--adaptive_tolerance", type=float, default=None,
+                        help="Adaptive ensemble: stop adding folds once a fold flips at most this fraction of "
+                             "the segmented voxels (e.g., 0.01)")
+    parser.add_argument("--memory_budget", type=float, default=2048,
+                        help="Memory budget (MB) per forward pass, determines how many (mirrored) patches are batched")
+    parser.add_argument("--accumulator_dtype", choices=["float32", "float16"], default="float32",
+                        help="Data type of the running softmax accumulator of the ensemble")
+    parser.add_argument("--aggregation_budget", type=float, default=None,
+                        help="Memory budget (MB) for the softmax accumulator and sliding-window aggregation buffers: "
+                             "batched cases are predicted in groups that fit, and buffers are stored as float16 "
+                             "when float32 buffers exceed the budget")
+    parser.add_argument("--store_probability_maps", action="store_true",
+                        help="Let nnU-Net store the full softmax of each case (cli backend)")
+    parser.add_argument("--probability_map", choices=["uint8", "float16"], default=None,
+                        help="Store the prostate probability within the gland bounding box as memory-mappable "
+                             ".pmap file next to the segmentation (see probability_map.py)")
+    parser.add_argument("--latency_budget", type=float, default=None,
+                        help="Target seconds per case: use the most accurate mirror axes, step size and number of "
+                             "folds within this budget (see latency_planner.py)")
+    parser.add_argument("--latency_plan_dir", type=Path, default=None,
+                        help="Folder to store the latency benchmark of this machine (default: model folder)")
+    parser.add_argument("--cascade", action="store_true",
+                        help="Locate the gland with a single patch, and run the sliding window only on its bounding box")
+    parser.add_argument("--preview", action="store_true",
+                        help="Write a low-resolution segmentation and the gland volume first (single fold, coarser "
+                             "spacing, no TTA), which the full-resolution ensemble replaces when finished")
+    parser.add_argument("--serve", action="store_true",
+                        help="Keep the model loaded and segment cases submitted over HTTP (localhost only)")
+    parser.add_argument("--port", type=int, default=8000,
+                        help="Port of the inference service (with --serve)")
+    parser.add_argument("--max_batch_size", type=int, default=4,
+                        help="Maximum number of concurrent requests per batched forward pass (with --serve)")
+    args, _ = parser.parse_known_args()
+
+    algorithm = ProstateSegmentationAlgorithm(
+        batch_mode=args.batch,
+        backend=args.backend,
+        debug=args.debug,
+        crop_on_read=not args.no_crop_on_read,
+        fused_preprocessing=args.fused_preprocessing,
+        profile=args.profile,
+        service_mode=args.serve,
+        num_workers=args.num_workers,
+        result_cache_dir=args.result_cache,
+        result_cache_size=args.result_cache_size,
+        fold_softmax_dir=args.fold_softmax_store,
+        adaptive_tolerance=args.adaptive_tolerance,
+        memory_budget=args.memory_budget,
+        latency_budget=args.latency_budget,
+        latency_plan_dir=args.latency_plan_dir,
+        cascade=args.cascade,
+        preview=args.preview,
+        accumulator_dtype=args.accumulator_dtype,
+        aggregation_budget=args.aggregation_budget,
+        store_probability_maps=args.store_probability_maps,
+        probability_map=args.probability_map,
+        weight_store=args.weight_store,
+    )
+    if args.serve:
+        from inference_service import serve
+        serve(algorithm, port=args.port, max_batch_size=args.max_batch_size)
+    else:
+        algorithm.process()
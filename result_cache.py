@@ -0,0 +1,130 @@
+import hashlib
+import json
+import os
+import shutil
+import threading
+from pathlib import Path
+from typing import Dict, Iterable, Union
+
+import numpy as np
+import SimpleITK as sitk
+
+from atomic_io import atomic_open, atomic_write_bytes
+
+PathLike = Union[str, Path]
+
+"""
+Content-addressed store of segmentation results on local disk. Results are keyed by the
+hash of the input scans (pixel data plus geometry) and of the model identity (plans,
+checkpoints and inference settings), such that a repeated study is not segmented twice.
+The store is limited in size, and the least recently used results are evicted first.
+"""
+
+
+def hash_image(image: sitk.Image) -> str:
+    """Hash of the pixel data and geometry of an image (independent of file format and metadata)"""
+    h = hashlib.sha256()
+    h.update(json.dumps(dict(
+        pixel_type=image.GetPixelIDTypeAsString(),
+        components=image.GetNumberOfComponentsPerPixel(),
+        size=image.GetSize(),
+        spacing=image.GetSpacing(),
+        origin=image.GetOrigin(),
+        direction=image.GetDirection(),
+    )).encode("utf-8"))
+    h.update(np.ascontiguousarray(sitk.GetArrayViewFromImage(image)).data)
+    return h.hexdigest()
+
+
+class ResultCache:
+    """Least recently used store of result files (e.g., prostate_gland.mha), limited in total size"""
+
+    def __init__(self, cache_dir: PathLike, max_size: int = 2 * 1024**3, suffix: str = ".mha"):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.suffix = suffix
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # digests of model files, identified by path, size and modification time
+        self._digests_path = self.cache_dir / "file_digests.json"
+        self._digests: Dict[str, str] = {}
+        if self._digests_path.exists():
+            try:
+                self._digests = json.loads(self._digests_path.read_text())
+            except ValueError:
+                self._digests = {}
+        self._lock = threading.Lock()
+
+    def file_digest(self, path: PathLike) -> str:
+        """SHA-256 of a file, memoized on disk such that large checkpoints are hashed only once"""
+        path = Path(path).resolve()
+        stat = path.stat()
+        key = f"{path}:{stat.st_size}:{stat.st_mtime_ns}"
+        with self._lock:
+            if key in self._digests:
+                return self._digests[key]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as fp:
+            for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+                h.update(chunk)
+
+        with self._lock:
+            self._digests[key] = h.hexdigest()
+            atomic_write_bytes(self._digests_path, json.dumps(self._digests, indent=1).encode("utf-8"))
+        return h.hexdigest()
+
+    def model_key(self, files: Iterable[PathLike], settings: dict) -> str:
+        """Identity of a model: digests of its files (plans, checkpoints) and the inference settings"""
+        h = hashlib.sha256()
+        for path in files:
+            h.update(self.file_digest(path).encode("utf-8"))
+        h.update(json.dumps(settings, sort_keys=True, default=str).encode("utf-8"))
+        return h.hexdigest()
+
+    @staticmethod
+    def case_key(image_hashes: Iterable[str], model_key: str) -> str:
+        """Key of a result: hash of the input scans (in order) and of the model"""
+        return hashlib.sha256("".join(list(image_hashes) + [model_key]).encode("utf-8")).hexdigest()
+
+    def path(self, key: str) -> Path:
+        return self.cache_dir / key[:2] / f"{key}{self.suffix}"
+
+    def get(self, key: str, output_path: PathLike) -> bool:
+        """Copy the cached result to output_path, returns whether the result was found"""
+        path = self.path(key)
+        try:
+            # mark as recently used
+            os.utime(path)
+            atomic_write_bytes(Path(output_path), path.read_bytes())
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key: str, result_path: PathLike) -> None:
+        """Store a result file, and evict the least recently used results if the store is too large"""
+        path = self.path(key)
+        path.parent.mkdir(exist_ok=True)
+        with open(result_path, "rb") as src, atomic_open(path) as fp:
+            shutil.copyfileobj(src, fp)
+        self.evict()
+
+    def evict(self) -> None:
+        """Remove the least recently used results until the store is within its size limit"""
+        entries = []
+        for path in self.cache_dir.glob(f"*/*{self.suffix}"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue  # evicted by another process
+            entries.append((stat.st_mtime_ns, stat.st_size, path))
+
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
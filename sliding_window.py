@@ -0,0 +1,154 @@
+import itertools
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from batchgenerators.augmentations.utils import pad_nd_image
+from nnunet.network_architecture.neural_network import SegmentationNetwork
+
+# callable that maps a batch of patches (B, C, z, y, x) to logits (B, K, z, y, x)
+RunFunction = Callable[[np.ndarray], np.ndarray]
+
+
+def softmax(logits: np.ndarray, axis: int = 1) -> np.ndarray:
+    """Numerically stable softmax"""
+    e = np.exp(logits - logits.max(axis=axis, keepdims=True))
+    return e / e.sum(axis=axis, keepdims=True)
+
+
+def get_mirror_combinations(mirror_axes: Sequence[int], do_mirroring: bool = True) -> List[Tuple[int, ...]]:
+    """All combinations of spatial axes to flip, in the order used by nnU-Net (including no flip)"""
+    if not do_mirroring:
+        return [()]
+    combinations = [()]
+    for axis in sorted(mirror_axes, reverse=True):
+        combinations += [c + (axis,) for c in combinations]
+    return combinations
+
+
+class SlidingWindowInference:
+    """
+    Sliding-window inference with Gaussian importance weighting and mirror test-time
+    augmentation, equivalent to SegmentationNetwork._internal_predict_3D_3Dconv_tiled,
+    but for any callable that produces logits (e.g., an exported network), and with
+    mirrored variants and patches stacked into batched forward passes.
+    """
+
+    def __init__(self, patch_size: Sequence[int], num_classes: int, mirror_axes: Sequence[int] = (0, 1, 2)):
+        self.patch_size = tuple(int(p) for p in patch_size)
+        self.num_classes = num_classes
+        self.mirror_axes = tuple(mirror_axes)
+
+        # Gaussian importance map is computed once and reused for all patches
+        self.gaussian = SegmentationNetwork._get_gaussian(self.patch_size, sigma_scale=1. / 8)
+
+    def get_patch_slicers(self, shape: Sequence[int], step_size: float) -> List[Tuple[slice, ...]]:
+        """Spatial slicers of all patches for an image of the specified (padded) shape"""
+        steps = SegmentationNetwork._compute_steps_for_sliding_window(self.patch_size, shape, step_size)
+        return [
+            tuple(slice(s, s + p) for s, p in zip(start, self.patch_size))
+            for start in itertools.product(*steps)
+        ]
+
+    def predict(
+        self,
+        run_fn: RunFunction,
+        data: np.ndarray,
+        do_mirroring: bool = True,
+        step_size: float = 0.5,
+        batch_size: int = 1,
+        aggregation_budget: Optional[float] = None,
+    ) -> np.ndarray:
+        """Softmax (K, z, y, x) for preprocessed data (C, z, y, x)"""
+        return self.predict_many(run_fn, [data], do_mirroring=do_mirroring, step_size=step_size,
+                                 batch_size=batch_size, aggregation_budget=aggregation_budget)[0]
+
+    def aggregation_nbytes(self, shapes: Sequence[Sequence[int]], dtype=np.float32) -> int:
+        """
+        Size (bytes) of the aggregation buffers (softmax sum in the specified data type, and the float32
+        number of predictions) for cases of the specified spatial shapes, padded to the patch size
+        """
+        itemsize = np.dtype(dtype).itemsize
+        return sum(
+            (self.num_classes * itemsize + 4) * int(np.prod([max(s, p) for s, p in zip(shape, self.patch_size)]))
+            for shape in shapes
+        )
+
+    def aggregation_dtype(self, shapes: Sequence[Sequence[int]], aggregation_budget: Optional[float] = None):
+        """
+        Data type of the aggregation buffers for cases of the specified spatial shapes: float32, or
+        float16 when the float32 buffers do not fit in the aggregation budget (MB)
+        """
+        if aggregation_budget is None:
+            return np.float32
+        return np.float32 if self.aggregation_nbytes(shapes) <= aggregation_budget * 1024**2 else np.float16
+
+    def predict_many(
+        self,
+        run_fn: RunFunction,
+        datas: List[np.ndarray],
+        do_mirroring: bool = True,
+        step_size: float = 0.5,
+        batch_size: int = 1,
+        aggregation_budget: Optional[float] = None,
+    ) -> List[np.ndarray]:
+        """
+        Softmax (K, z, y, x) for each of multiple preprocessed cases (C, z, y, x). The mirrored
+        variants of all patches of all cases are stacked, and run through the network in
+        batches of `batch_size` (e.g., all eight mirrors of a patch, or several patches).
+        The softmax is aggregated in float16 when float32 buffers exceed the aggregation
+        budget (MB, default: no limit), and normalised in place: the results are views of the
+        aggregation buffers, such that no further copy is allocated.
+        """
+        padded, slicers, importances = [], [], []
+        for data in datas:
+            padded_data, slicer = pad_nd_image(data, self.patch_size, "constant", {'constant_values': 0}, True, None)
+            patch_slicers = self.get_patch_slicers(padded_data.shape[1:], step_size)
+            padded.append(padded_data)
+            slicers.append(slicer)
+            importances.append(self.gaussian if len(patch_slicers) > 1 else np.ones(self.patch_size, dtype=np.float32))
+
+        dtype = self.aggregation_dtype([data.shape[1:] for data in datas], aggregation_budget)
+        aggregated_results = [
+            np.zeros((self.num_classes,) + padded_data.shape[1:], dtype=dtype) for padded_data in padded
+        ]
+        aggregated_nb_of_predictions = [np.zeros(padded_data.shape[1:], dtype=np.float32) for padded_data in padded]
+
+        # all patches, as (case index, spatial slicer), and all mirrored variants of each patch
+        patches = [
+            (i, patch_slicer)
+            for i, padded_data in enumerate(padded)
+            for patch_slicer in self.get_patch_slicers(padded_data.shape[1:], step_size)
+        ]
+        mirrors = get_mirror_combinations(self.mirror_axes, do_mirroring)
+        items = [(p, tuple(a + 1 for a in axes)) for p in range(len(patches)) for axes in mirrors]
+
+        # softmax of patches, summed over the mirrors processed so far
+        patch_results, patch_counts = {}, {}
+        for start in range(0, len(items), batch_size):
+            batch_items = items[start:start + batch_size]
+            batch = []
+            for p, flip_axes in batch_items:
+                i, patch_slicer = patches[p]
+                x = padded[i][(slice(None),) + patch_slicer]
+                batch.append(np.flip(x, flip_axes) if flip_axes else x)
+            pred = softmax(run_fn(np.ascontiguousarray(np.stack(batch), dtype=np.float32)))
+
+            for (p, flip_axes), patch_pred in zip(batch_items, pred):
+                patch_pred = np.flip(patch_pred, flip_axes) if flip_axes else patch_pred
+                patch_results[p] = patch_results[p] + patch_pred if p in patch_results else patch_pred
+                patch_counts[p] = patch_counts.get(p, 0) + 1
+                if patch_counts[p] == len(mirrors):
+                    # all mirrors of this patch are done
+                    i, patch_slicer = patches[p]
+                    result = patch_results.pop(p) / len(mirrors)
+                    aggregated_results[i][(slice(None),) + patch_slicer] += result * importances[i]
+                    aggregated_nb_of_predictions[i][patch_slicer] += importances[i]
+
+        # remove padding and normalise
+        results = []
+        for slicer, aggregated, nb_of_predictions in zip(slicers, aggregated_results, aggregated_nb_of_predictions):
+            aggregated = aggregated[(slice(None),) + tuple(slicer[1:])]
+            nb_of_predictions = nb_of_predictions[tuple(slicer[1:])]
+            aggregated /= nb_of_predictions[None]
+            results.append(aggregated)
+        return results
@@ -0,0 +1,167 @@
+import argparse
+import json
+import pickle
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence, Union
+
+import numpy as np
+import SimpleITK as sitk
+
+from atomic_io import atomic_open, atomic_write_bytes
+
+PathLike = Union[str, Path]
+
+"""
+On-disk store with the softmax prediction of each fold for each case, such that ensembles
+(fold subsets), binarization thresholds and postprocessing can be re-evaluated without
+running the networks again. The softmax of each fold is stored as float16 .npy file (at
+the resolution of the network, before resampling to the input grid), which is memory-mapped
+when read.
+
+store/
+|-- store.json  (model settings)
+|-- postprocessing.json  (postprocessing of the model, if any)
+|-- [case_id]/
+|---- properties.pkl  (nnU-Net properties, to export the segmentation)
+|---- fold_0.npy
+|---- fold_1.npy ...
+"""
+
+
+class FoldSoftmaxStore:
+    def __init__(self, store_dir: PathLike):
+        self.store_dir = Path(store_dir)
+        self.store_dir.mkdir(parents=True, exist_ok=True)
+
+    def write_metadata(self, metadata: dict, postprocessing_file: Optional[PathLike] = None) -> None:
+        """Store the model settings (and postprocessing) the softmax predictions were made with"""
+        atomic_write_bytes(self.store_dir / "store.json", json.dumps(metadata, indent=4).encode("utf-8"))
+        if postprocessing_file is not None and Path(postprocessing_file).exists():
+            atomic_write_bytes(self.store_dir / "postprocessing.json", Path(postprocessing_file).read_bytes())
+
+    def write_properties(self, case_id: str, properties: dict) -> None:
+        (self.store_dir / case_id).mkdir(exist_ok=True)
+        atomic_write_bytes(self.store_dir / case_id / "properties.pkl", pickle.dumps(properties))
+
+    def write_fold_softmax(self, case_id: str, fold: Union[int, str], softmax: np.ndarray) -> None:
+        (self.store_dir / case_id).mkdir(exist_ok=True)
+        path = self.store_dir / case_id / f"fold_{fold}.npy"
+        with atomic_open(path) as fp:
+            np.save(fp, softmax.astype(np.float16))
+
+    def case_ids(self) -> List[str]:
+        return sorted(path.parent.name for path in self.store_dir.glob("*/properties.pkl"))
+
+    def folds(self, case_id: str) -> List[str]:
+        return sorted(path.stem[len("fold_"):] for path in (self.store_dir / case_id).glob("fold_*.npy"))
+
+    def read_properties(self, case_id: str) -> dict:
+        with open(self.store_dir / case_id / "properties.pkl", "rb") as fp:
+            return pickle.load(fp)
+
+    def read_fold_softmax(self, case_id: str, fold: Union[int, str]) -> np.ndarray:
+        """Memory-mapped (read-only) softmax of a single fold"""
+        return np.load(self.store_dir / case_id / f"fold_{fold}.npy", mmap_mode="r")
+
+    def ensemble(self, case_id: str, folds: Optional[Sequence[Union[int, str]]] = None) -> np.ndarray:
+        """Average the softmax of the specified folds (default: all stored folds)"""
+        if folds is None:
+            folds = self.folds(case_id)
+        softmax: Optional[np.ndarray] = None
+        for fold in folds:
+            fold_softmax = self.read_fold_softmax(case_id, fold)
+            if softmax is None:
+                softmax = fold_softmax.astype(np.float32)
+            else:
+                softmax += fold_softmax
+        return softmax / len(folds)
+
+    def postprocessing(self):
+        """Postprocessing of the model the softmax predictions were made with (for_which_classes, min_valid_obj_size)"""
+        from nnunet.postprocessing.connected_components import \
+            load_postprocessing
+
+        pp_file = self.store_dir / "postprocessing.json"
+        if not pp_file.exists():
+            return None, None
+        return load_postprocessing(str(pp_file))
+
+
+def dice_score(pred: np.ndarray, lbl: np.ndarray) -> float:
+    intersection = np.sum((pred == 1) & (lbl == 1))
+    volumes = np.sum(pred == 1) + np.sum(lbl == 1)
+    return 2 * intersection / volumes if volumes else 1.0
+
+
+def rebuild_segmentations(
+    store: FoldSoftmaxStore,
+    folds: Optional[Sequence[str]] = None,
+    thresholds: Sequence[Optional[float]] = (None,),
+    postprocessing: Union[str, PathLike, None] = "model",
+    output_dir: Optional[Path] = None,
+    labels_dir: Optional[Path] = None,
+) -> Dict[str, Dict[str, float]]:
+    """
+    Rebuild the segmentation of all cases in the store, for a subset of folds and one or more
+    thresholds on the foreground probability (None: argmax). Postprocessing is "model" (as stored),
+    None, or the path to a postprocessing.json. Returns the Dice score per threshold and case,
+    if labels are provided.
+    """
+    from nnunet.postprocessing.connected_components import \
+        load_postprocessing
+    from nnunet_predictor import export_segmentation
+
+    if postprocessing == "model":
+        for_which_classes, min_valid_obj_size = store.postprocessing()
+    elif postprocessing is None:
+        for_which_classes, min_valid_obj_size = None, None
+    else:
+        for_which_classes, min_valid_obj_size = load_postprocessing(str(postprocessing))
+
+    scores = {str(threshold): {} for threshold in thresholds}
+    for case_id in store.case_ids():
+        softmax = store.ensemble(case_id, folds=folds)
+        properties = store.read_properties(case_id)
+        lbl = None
+        if labels_dir is not None:
+            lbl = sitk.GetArrayFromImage(sitk.ReadImage(str(Path(labels_dir) / f"{case_id}.nii.gz")))
+
+        for threshold in thresholds:
+            pred = export_segmentation(softmax, properties, for_which_classes=for_which_classes,
+                                       min_valid_obj_size=min_valid_obj_size, threshold=threshold)
+            if output_dir is not None:
+                case_output_dir = Path(output_dir) if len(thresholds) == 1 else Path(output_dir) / f"threshold_{threshold}"
+                case_output_dir.mkdir(parents=True, exist_ok=True)
+                sitk.WriteImage(pred, str(case_output_dir / f"{case_id}.nii.gz"), True)
+            if lbl is not None:
+                scores[str(threshold)][case_id] = dice_score(sitk.GetArrayViewFromImage(pred), lbl)
+    return scores
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild segmentations from the per-fold softmax store")
+    parser.add_argument("--store", type=Path, required=True)
+    parser.add_argument("--folds", default=None,
+                        help="Comma-separated subset of folds to ensemble (default: all stored folds)")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=None,
+                        help="Thresholds on the foreground probability (default: argmax)")
+    parser.add_argument("--postprocessing", default="model",
+                        help="'model' (postprocessing stored with the softmax), 'none', or path to postprocessing.json")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Folder to store the segmentations (subfolder per threshold for multiple thresholds)")
+    parser.add_argument("--labels", type=Path, default=None,
+                        help="Folder with annotations ([case_id].nii.gz) to calculate the Dice score")
+    args = parser.parse_args()
+
+    scores = rebuild_segmentations(
+        store=FoldSoftmaxStore(args.store),
+        folds=args.folds.split(",") if args.folds is not None else None,
+        thresholds=args.thresholds if args.thresholds is not None else [None],
+        postprocessing=None if args.postprocessing == "none" else args.postprocessing,
+        output_dir=args.output,
+        labels_dir=args.labels,
+    )
+    for threshold, case_scores in scores.items():
+        if case_scores:
+            print(f"Threshold {threshold}: Dice {np.mean(list(case_scores.values())):.4f} "
+                  f"± {np.std(list(case_scores.values())):.4f} ({len(case_scores)} cases)")
@@ -28,6 +28,41 @@ else
     echo "Expected output was not found..."
 fi
 
+# check that reading only the field of view gives the same output as reading the full scans
+DOCKER_FILE_SHARE_FULL=picai_prostate_segmentation_processor-output-full-$VOLUME_SUFFIX
+docker volume create $DOCKER_FILE_SHARE_FULL
+
+docker run --rm \
+        -v $SCRIPTPATH/test/:/input/ \
+        -v $DOCKER_FILE_SHARE_FULL:/output/ \
+        joeranbosma/picai_prostate_segmentation_processor:latest --no_crop_on_read
+
+docker run --rm \
+        -v $DOCKER_FILE_SHARE:/output/ \
+        -v $DOCKER_FILE_SHARE_FULL:/output_full/ \
+        insighttoolkit/simpleitk-notebooks:latest python -c "import sys; import numpy as np; import SimpleITK as sitk; f1 = sitk.GetArrayFromImage(sitk.ReadImage('/output/images/transverse-whole-prostate-mri/prostate_gland.mha')); f2 = sitk.GetArrayFromImage(sitk.ReadImage('/output_full/images/transverse-whole-prostate-mri/prostate_gland.mha')); print('Pixels different between crop on read and full scans:', np.abs(f1!=f2).sum()); sys.exit(int(np.abs(f1!=f2).sum() > 0));"
+
+if [ $? -eq 0 ]; then
+    echo "Crop on read gives identical output..."
+else
+    echo "Crop on read output differs from full-scan output..."
+fi
+
+# check that the exported (ONNX) ensemble gives the same segmentation as the eager PyTorch ensemble
+docker run --rm \
+        -v $SCRIPTPATH/test/:/input/ \
+        --entrypoint python \
+        joeranbosma/picai_prostate_segmentation_processor:latest network_export.py --engine onnx \
+        --validate /input/images/transverse-t2-prostate-mri/ProstateX-0000_07-07-2011_t2w.mha \
+                   /input/images/transverse-adc-prostate-mri/ProstateX-0000_07-07-2011_adc.mha \
+                   /input/images/transverse-hbv-prostate-mri/ProstateX-0000_07-07-2011_hbv.mha
+
+if [ $? -eq 0 ]; then
+    echo "Exported ensemble matches the eager ensemble..."
+else
+    echo "Exported ensemble differs from the eager ensemble..."
+fi
 
 docker volume rm $DOCKER_FILE_SHARE
+docker volume rm $DOCKER_FILE_SHARE_FULL
 
@@ -0,0 +1,22 @@
+import pytest
+
+from atomic_io import atomic_open, atomic_write_bytes
+
+
+def test_atomic_write_replaces_file(tmp_path):
+    path = tmp_path / "prostate-volume.json"
+    path.write_bytes(b"old")
+    atomic_write_bytes(path, b"new")
+    assert path.read_bytes() == b"new"
+    assert [p.name for p in tmp_path.iterdir()] == ["prostate-volume.json"]
+
+
+def test_atomic_open_keeps_file_on_error(tmp_path):
+    path = tmp_path / "store.json"
+    path.write_bytes(b"old")
+    with pytest.raises(RuntimeError):
+        with atomic_open(path) as fp:
+            fp.write(b"partial")
+            raise RuntimeError("interrupted")
+    assert path.read_bytes() == b"old"
+    assert [p.name for p in tmp_path.iterdir()] == ["store.json"]
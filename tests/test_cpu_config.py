@@ -0,0 +1,86 @@
+import pytest
+
+import cpu_config
+from cpu_config import cgroup_cpu_quota, detect_cpu_config, env_int
+
+
+@pytest.fixture
+def cgroup_root(tmp_path, monkeypatch):
+    """Empty cgroup filesystem and /proc/self/cgroup, in a temporary folder"""
+    root = tmp_path / "cgroup"
+    root.mkdir()
+    monkeypatch.setattr(cpu_config, "CGROUP_ROOT", root)
+    monkeypatch.setattr(cpu_config, "PROC_CGROUP", tmp_path / "proc_cgroup")
+    return root
+
+
+def write_file(path, content):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(content)
+
+
+def test_cgroup_v2_quota(cgroup_root):
+    write_file(cpu_config.PROC_CGROUP, "0::/\n")
+    write_file(cgroup_root / "cpu.max", "150000 100000\n")
+    assert cgroup_cpu_quota() == pytest.approx(1.5)
+
+
+def test_cgroup_v2_unlimited(cgroup_root):
+    write_file(cpu_config.PROC_CGROUP, "0::/\n")
+    write_file(cgroup_root / "cpu.max", "max 100000\n")
+    assert cgroup_cpu_quota() is None
+
+
+def test_cgroup_v2_nested_uses_smallest_quota(cgroup_root):
+    write_file(cpu_config.PROC_CGROUP, "0::/docker/abc\n")
+    write_file(cgroup_root / "cpu.max", "400000 100000\n")
+    write_file(cgroup_root / "docker" / "cpu.max", "max 100000\n")
+    write_file(cgroup_root / "docker" / "abc" / "cpu.max", "200000 100000\n")
+    assert cgroup_cpu_quota() == pytest.approx(2.0)
+
+
+def test_cgroup_v1_quota(cgroup_root):
+    write_file(cpu_config.PROC_CGROUP, "5:memory:/docker/abc\n4:cpu,cpuacct:/docker/abc\n")
+    folder = cgroup_root / "cpu,cpuacct" / "docker" / "abc"
+    write_file(folder / "cpu.cfs_quota_us", "50000\n")
+    write_file(folder / "cpu.cfs_period_us", "100000\n")
+    assert cgroup_cpu_quota() == pytest.approx(0.5)
+
+
+def test_cgroup_v1_unlimited(cgroup_root):
+    write_file(cpu_config.PROC_CGROUP, "4:cpu,cpuacct:/\n")
+    write_file(cgroup_root / "cpu" / "cpu.cfs_quota_us", "-1\n")
+    write_file(cgroup_root / "cpu" / "cpu.cfs_period_us", "100000\n")
+    assert cgroup_cpu_quota() is None
+
+
+def test_cgroup_missing(cgroup_root):
+    assert cgroup_cpu_quota() is None
+
+
+def test_env_int(monkeypatch):
+    monkeypatch.setenv("PROSTATE_TEST_THREADS", "0")
+    assert env_int("PROSTATE_TEST_THREADS") == 1
+    monkeypatch.setenv("PROSTATE_TEST_THREADS", " ")
+    assert env_int("PROSTATE_TEST_THREADS") is None
+    monkeypatch.setenv("PROSTATE_TEST_THREADS", "four")
+    with pytest.raises(ValueError):
+        env_int("PROSTATE_TEST_THREADS")
+
+
+@pytest.mark.parametrize("num_cpus, num_workers, torch_threads, io_workers, sitk_threads", [
+    (8, 1, 8, 3, 2),
+    (8, 2, 4, 3, 1),
+    (8, 4, 2, 2, 1),
+    (2, 4, 1, 1, 1),
+])
+def test_detect_cpu_config(monkeypatch, num_cpus, num_workers, torch_threads, io_workers, sitk_threads):
+    for name in ("PROSTATE_TORCH_THREADS", "OMP_NUM_THREADS", "PROSTATE_SITK_THREADS", "PROSTATE_IO_WORKERS"):
+        monkeypatch.delenv(name, raising=False)
+    monkeypatch.setenv("PROSTATE_NUM_CPUS", str(num_cpus))
+    config = detect_cpu_config(num_workers=num_workers)
+    assert config.num_cpus == num_cpus
+    assert config.torch_threads == torch_threads
+    assert config.omp_threads == torch_threads
+    assert config.io_workers == io_workers
+    assert config.sitk_threads == sitk_threads
@@ -0,0 +1,88 @@
+import pytest
+
+np = pytest.importorskip("numpy")
+sitk = pytest.importorskip("SimpleITK")
+probability_map = pytest.importorskip("probability_map")
+
+SPACING = (0.5, 0.5, 3.0)
+ORIGIN = (-10.0, 20.0, 5.0)
+DIRECTION = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+
+def make_case(shape=(10, 40, 50)):
+    """Segmentation and foreground probability (z, y, x) with a box-shaped gland"""
+    seg = np.zeros(shape, dtype=np.uint8)
+    seg[4:6, 15:25, 20:30] = 1
+    rng = np.random.default_rng(0)
+    probabilities = rng.random(shape).astype(np.float32)
+    return seg, probabilities
+
+
+def test_gland_bounding_box():
+    seg, _ = make_case()
+    bbox = probability_map.gland_bounding_box(seg, SPACING, margin=5.0)
+    # margin of 5 mm: 2 slices of 3 mm, 10 voxels of 0.5 mm (clipped to the image)
+    assert bbox == (slice(2, 8), slice(5, 35), slice(10, 40))
+
+
+def test_gland_bounding_box_empty():
+    bbox = probability_map.gland_bounding_box(np.zeros((4, 5, 6), dtype=np.uint8), SPACING)
+    assert all(s.stop - s.start == 0 for s in bbox)
+
+
+@pytest.mark.parametrize("dtype, tolerance", [("uint8", 0.5 / 255 + 1e-6), ("float16", 1e-3)])
+def test_write_read_round_trip(tmp_path, dtype, tolerance):
+    seg, probabilities = make_case()
+    bbox = probability_map.gland_bounding_box(seg, SPACING)
+    path = tmp_path / "prostate_gland.pmap"
+    probability_map.write_probability_map(path, probabilities[bbox], bbox, spacing=SPACING, origin=ORIGIN,
+                                          direction=DIRECTION, dtype=dtype)
+
+    data, header = probability_map.read_probability_map(path)
+    assert header["dtype"] == dtype
+    assert data.shape == probabilities[bbox].shape
+    np.testing.assert_allclose(np.asarray(data, dtype=np.float32) * header["scale"], probabilities[bbox],
+                               atol=tolerance)
+
+    # the cropped grid is aligned with the full grid
+    full = sitk.GetImageFromArray(probabilities)
+    full.SetSpacing(SPACING)
+    full.SetOrigin(ORIGIN)
+    full.SetDirection(DIRECTION)
+    image = probability_map.probability_map_to_image(path)
+    start = [s.start for s in bbox][::-1]
+    np.testing.assert_allclose(image.GetOrigin(), full.TransformIndexToPhysicalPoint(start))
+    np.testing.assert_allclose(image.GetSpacing(), SPACING)
+
+
+def test_write_read_empty(tmp_path):
+    seg = np.zeros((4, 5, 6), dtype=np.uint8)
+    bbox = probability_map.gland_bounding_box(seg, SPACING)
+    path = tmp_path / "prostate_gland.pmap"
+    probability_map.write_probability_map(path, np.zeros((0, 0, 0), dtype=np.float32), bbox, spacing=SPACING,
+                                          origin=ORIGIN, direction=DIRECTION)
+    data, header = probability_map.read_probability_map(path)
+    assert data.shape == (0, 0, 0)
+
+
+def test_write_rejects_mismatching_shape(tmp_path):
+    seg, probabilities = make_case()
+    bbox = probability_map.gland_bounding_box(seg, SPACING)
+    with pytest.raises(ValueError):
+        probability_map.write_probability_map(tmp_path / "prostate_gland.pmap", probabilities, bbox,
+                                              spacing=SPACING, origin=ORIGIN, direction=DIRECTION)
+
+
+def test_write_rejects_unknown_dtype(tmp_path):
+    seg, probabilities = make_case()
+    bbox = probability_map.gland_bounding_box(seg, SPACING)
+    with pytest.raises(ValueError):
+        probability_map.write_probability_map(tmp_path / "prostate_gland.pmap", probabilities[bbox], bbox,
+                                              spacing=SPACING, origin=ORIGIN, direction=DIRECTION, dtype="int16")
+
+
+def test_read_rejects_other_files(tmp_path):
+    path = tmp_path / "prostate_gland.mha"
+    path.write_bytes(b"ObjectType = Image\n")
+    with pytest.raises(ValueError):
+        probability_map.read_probability_map(path)
@@ -0,0 +1,54 @@
+import os
+
+import pytest
+
+pytest.importorskip("numpy")
+pytest.importorskip("SimpleITK")
+result_cache = pytest.importorskip("result_cache")
+
+
+def put_result(cache, tmp_path, key, content, mtime):
+    """Store a result file in the cache, last used at mtime (seconds)"""
+    result_path = tmp_path / f"{key}.mha"
+    result_path.write_bytes(content)
+    cache.put(key, result_path)
+    os.utime(cache.path(key), (mtime, mtime))
+
+
+def test_get_put(tmp_path):
+    cache = result_cache.ResultCache(tmp_path / "cache", max_size=1024)
+    key = "ab" + "0" * 62
+    assert not cache.get(key, tmp_path / "output.mha")
+
+    put_result(cache, tmp_path, key, b"segmentation", mtime=1000)
+    assert cache.get(key, tmp_path / "output.mha")
+    assert (tmp_path / "output.mha").read_bytes() == b"segmentation"
+
+
+def test_evicts_least_recently_used(tmp_path):
+    cache = result_cache.ResultCache(tmp_path / "cache", max_size=25)
+    keys = [f"{i:02d}" + "0" * 62 for i in range(3)]
+    put_result(cache, tmp_path, keys[0], b"0" * 10, mtime=1000)
+    put_result(cache, tmp_path, keys[1], b"1" * 10, mtime=2000)
+
+    # using the first result makes the second the least recently used
+    assert cache.get(keys[0], tmp_path / "output.mha")
+    put_result(cache, tmp_path, keys[2], b"2" * 10, mtime=os.path.getmtime(cache.path(keys[0])) + 1)
+
+    assert cache.path(keys[0]).exists()
+    assert not cache.path(keys[1]).exists()
+    assert cache.path(keys[2]).exists()
+
+
+def test_model_key_depends_on_files_and_settings(tmp_path):
+    cache = result_cache.ResultCache(tmp_path / "cache")
+    checkpoint = tmp_path / "model_final_checkpoint.model"
+    checkpoint.write_bytes(b"weights")
+
+    key = cache.model_key([checkpoint], dict(folds="0,1,2,3,4"))
+    assert key == cache.model_key([checkpoint], dict(folds="0,1,2,3,4"))
+    assert key != cache.model_key([checkpoint], dict(folds="0,1,2"))
+
+    checkpoint.write_bytes(b"new weights")
+    os.utime(checkpoint, (0, 0))
+    assert key != cache.model_key([checkpoint], dict(folds="0,1,2,3,4"))
@@ -0,0 +1,65 @@
+import json
+from collections import OrderedDict
+
+import pytest
+
+np = pytest.importorskip("numpy")
+pytest.importorskip("torch")
+pytest.importorskip("picai_prep")
+weight_store = pytest.importorskip("weight_store")
+
+
+def test_encode_decode_plans():
+    plans = OrderedDict(
+        num_stages=1,
+        plans_per_stage={0: dict(
+            patch_size=np.array([16, 320, 320]),
+            current_spacing=np.array([3.0, 0.5, 0.5], dtype=np.float64),
+            pool_op_kernel_sizes=[[1, 2, 2], [2, 2, 2]],
+        )},
+        transpose_forward=(0, 1, 2),
+        normalization_schemes=OrderedDict([(0, "nonCT"), (1, "nonCT"), (2, "nonCT")]),
+        use_mask_for_norm=OrderedDict([(0, False), (1, False), (2, False)]),
+        dataset_properties=dict(intensityproperties=None, modalities={0: "T2W", 1: "ADC", 2: "HBV"}),
+        base_num_features=np.int64(32),
+    )
+
+    # the encoded plans are plain JSON
+    decoded = weight_store.decode(json.loads(json.dumps(weight_store.encode(plans))))
+
+    assert isinstance(decoded, OrderedDict)
+    assert list(decoded) == list(plans)
+    assert decoded["transpose_forward"] == (0, 1, 2)
+    assert isinstance(decoded["normalization_schemes"], OrderedDict)
+    assert list(decoded["plans_per_stage"]) == [0]
+    stage = decoded["plans_per_stage"][0]
+    assert stage["patch_size"].dtype == plans["plans_per_stage"][0]["patch_size"].dtype
+    np.testing.assert_array_equal(stage["patch_size"], [16, 320, 320])
+    np.testing.assert_array_equal(stage["current_spacing"], [3.0, 0.5, 0.5])
+    assert stage["pool_op_kernel_sizes"] == [[1, 2, 2], [2, 2, 2]]
+    assert decoded["dataset_properties"]["modalities"] == {0: "T2W", 1: "ADC", 2: "HBV"}
+    assert decoded["base_num_features"] == 32
+
+
+def test_encode_unsupported_type():
+    with pytest.raises(TypeError):
+        weight_store.encode(dict(value=object()))
+
+
+def test_read_header(tmp_path):
+    header = json.dumps(dict(trainer="nnUNetTrainerV2", tensors={})).encode("utf-8")
+    header += b" " * (-(len(weight_store.MAGIC) + 8 + len(header)) % weight_store.ALIGNMENT)
+    path = tmp_path / "model_final_checkpoint.weights"
+    path.write_bytes(weight_store.MAGIC + np.array(len(header), dtype="<u8").tobytes() + header)
+
+    read, data_start = weight_store.read_header(path)
+    assert read == dict(trainer="nnUNetTrainerV2", tensors={})
+    assert data_start == path.stat().st_size
+    assert data_start % weight_store.ALIGNMENT == 0
+
+
+def test_read_header_rejects_other_files(tmp_path):
+    path = tmp_path / "model_final_checkpoint.model"
+    path.write_bytes(b"PK\x03\x04" + b"\0" * 32)
+    with pytest.raises(ValueError):
+        weight_store.read_header(path)
@@ -0,0 +1,156 @@
+#  Copyright 2022 Diagnostic Image Analysis Group, Radboudumc, Nijmegen, The Netherlands
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import argparse
+import multiprocessing
+import os
+import pickle
+import resource
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+# inference engines live in the root of this repository
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+from network_export import collect_input_files, model_folder_path  # noqa: E402
+from nnunet_predictor import EnsemblePredictor  # noqa: E402
+
+"""
+Script to compare the latency, memory and segmentation performance of the inference
+engines (e.g., eager PyTorch, ONNX, INT8 quantized ONNX and the merged "fold soup"
+network) on the cross-validation cases
+
+Note: each cross-validation case was in the training set of four of the five folds, which
+favours the five-fold ensemble over single networks (e.g., the fold soup or the student), and
+over the quantized networks. Use held-out cases when available.
+"""
+
+# environment settings
+if 'workdir' in os.environ:
+    workdir = Path(os.environ['workdir'])
+else:
+    workdir = Path("/media/pelvis/projects/joeran/picai/workdir")
+
+# settings
+task = "Task2202_prostate_segmentation"
+trainer = "nnUNetTrainerV2_Loss_FL_and_CE_checkpoints"
+
+# paths
+results_dir = workdir / "results"
+splits_path = workdir / "nnUNet_preprocessed" / task / "splits_final.pkl"
+images_dir = workdir / "nnUNet_raw_data" / task / "imagesTr"
+labels_dir = workdir / "nnUNet_raw_data" / task / "labelsTr"
+
+# predictor settings for each inference engine
+engine_settings = {
+    "torch": dict(engine="torch"),
+    "torchscript": dict(engine="torchscript"),
+    "onnx": dict(engine="onnx"),
+    "onnx_int8": dict(engine="onnx_int8"),
+    "soup": dict(engine="torch", folds=[0], checkpoint="model_soup"),
+    "student": dict(engine="torch", folds=["all"], trainer="nnUNetTrainerV2_Loss_FL_and_CE_distillation"),
+}
+
+
+def collect_cv_cases(num_cases=None):
+    """Collect the validation cases of all cross-validation folds"""
+    with open(splits_path, "rb") as fp:
+        splits = pickle.load(fp)
+    case_ids = sorted(set(case_id for split in splits for case_id in split['val']))
+    if num_cases is not None:
+        case_ids = case_ids[:num_cases]
+    input_files = collect_input_files(images_dir)
+    return {case_id: input_files[case_id] for case_id in case_ids}
+
+
+def evaluate_engine(engine, cases, queue):
+    """Segment all cases with the specified engine, and report latency, memory and performance"""
+    settings = dict(engine_settings[engine])
+    model_folder = model_folder_path(results_dir, task=task, trainer=settings.pop('trainer', trainer))
+    predictor = EnsemblePredictor(model_folder=model_folder, **settings)
+    memory_model = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    res = []
+    for case_id, files in cases.items():
+        data, _, properties = predictor.trainer.preprocess_patient(files)
+
+        start = time.perf_counter()
+        softmax = predictor.predict_softmax(data)
+        latency = time.perf_counter() - start
+
+        pred = sitk.GetArrayFromImage(predictor.export_segmentation(softmax, properties))
+        lbl = sitk.GetArrayFromImage(sitk.ReadImage(str(labels_dir / f"{case_id}.nii.gz")))
+
+        # calculate Dice and Jaccard for the prostate gland
+        intersection = np.sum((pred == 1) & (lbl == 1))
+        volumes = np.sum(pred == 1) + np.sum(lbl == 1)
+        res += [{
+            "engine": engine,
+            "case_id": case_id,
+            "Dice": 2 * intersection / volumes if volumes else 1.0,
+            "Jaccard": intersection / (volumes - intersection) if volumes else 1.0,
+            "latency (s)": latency,
+        }]
+        np.save(f"{case_id}_{engine}.npy", pred)
+
+    memory_peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    for r in res:
+        r["memory model (MB)"] = memory_model
+        r["memory peak (MB)"] = memory_peak
+    queue.put(res)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--engines", nargs="+", choices=list(engine_settings), default=["torch", "onnx", "onnx_int8"],
+                        help="Inference engines to compare, the first engine is the reference")
+    parser.add_argument("--num_cases", type=int, default=None)
+    args = parser.parse_args()
+
+    cases = collect_cv_cases(num_cases=args.num_cases)
+    print(f"Evaluating {len(args.engines)} engines on {len(cases)} cases")
+
+    # evaluate each engine in a separate process, for a fair peak memory measurement
+    ctx = multiprocessing.get_context("spawn")
+    res = []
+    for engine in args.engines:
+        queue = ctx.Queue()
+        process = ctx.Process(target=evaluate_engine, args=(engine, cases, queue))
+        process.start()
+        res += queue.get()
+        process.join()
+    res = pd.DataFrame(res)
+
+    # agreement with the reference engine (first engine)
+    reference = args.engines[0]
+    for i, row in res.iterrows():
+        pred = np.load(f"{row['case_id']}_{row['engine']}.npy")
+        pred_reference = np.load(f"{row['case_id']}_{reference}.npy")
+        res.loc[i, f"voxels different from {reference}"] = int(np.sum(pred != pred_reference))
+    for row in res.itertuples():
+        os.remove(f"{row.case_id}_{row.engine}.npy")
+
+    # calculate mean ± std. per engine
+    summary = res.drop(columns="case_id").groupby("engine", sort=False).agg(["mean", "std"])
+    summary.columns = [f"{metric} {stat}" for metric, stat in summary.columns]
+    for metric in ["Dice", "Jaccard"]:
+        summary[f"{metric} difference"] = summary[f"{metric} mean"] - summary.loc[reference, f"{metric} mean"]
+    print(summary.to_string())
+
+    res.to_csv("inference_engines_cases.csv", index=False)
+    summary.to_csv("inference_engines.csv")
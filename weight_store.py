@@ -0,0 +1,201 @@
+import argparse
+import json
+import os
+from collections import OrderedDict
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Sequence, Tuple, Union
+
+import numpy as np
+import torch
+
+from atomic_io import atomic_open
+from network_export import (add_model_arguments, fold_folder,
+                            model_folder_from_args, parse_folds)
+
+PathLike = Union[str, Path]
+
+"""
+Flat, memory-mappable store of the weights of all folds of an nnU-Net model, together with
+the trainer configuration and plans (converted once from the checkpoints, .model.pkl files
+and plans.pkl). Networks are built from the header and use the mapped tensors directly
+(copy-on-write), such that no pickle is loaded at start-up, and processes on the same machine
+share the weights through the page cache.
+
+File layout ([checkpoint].weights in the model folder):
+- magic (8 bytes): b"NNUNETW1"
+- header length (uint64, little endian)
+- header (JSON, padded with spaces to a multiple of 64 bytes): trainer class and init
+  arguments, plans, and the dtype, shape and offset of each tensor of each fold
+- tensors (C order, each aligned to 64 bytes, offsets relative to the end of the header)
+"""
+
+MAGIC = b"NNUNETW1"
+ALIGNMENT = 64
+
+
+def weight_store_path(model_folder: PathLike, checkpoint: str) -> Path:
+    """Location of the weight store of a checkpoint (all folds), in the model folder"""
+    return Path(model_folder) / f"{checkpoint}.weights"
+
+
+def encode(value: Any) -> Any:
+    """Convert plans and init arguments to JSON, keeping numpy arrays, tuples and non-string keys"""
+    if isinstance(value, np.ndarray):
+        return {"__ndarray__": value.tolist(), "dtype": str(value.dtype)}
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, tuple):
+        return {"__tuple__": [encode(v) for v in value]}
+    if isinstance(value, dict):
+        return {"__dict__": [[encode(k), encode(v)] for k, v in value.items()],
+                "ordered": isinstance(value, OrderedDict)}
+    if isinstance(value, list):
+        return [encode(v) for v in value]
+    if value is None or isinstance(value, (str, int, float, bool)):
+        return value
+    raise TypeError(f"Cannot store value of type {type(value).__name__} in the weight store")
+
+
+def decode(value: Any) -> Any:
+    """Inverse of encode"""
+    if isinstance(value, list):
+        return [decode(v) for v in value]
+    if not isinstance(value, dict):
+        return value
+    if "__ndarray__" in value:
+        return np.array(value["__ndarray__"], dtype=value["dtype"])
+    if "__tuple__" in value:
+        return tuple(decode(v) for v in value["__tuple__"])
+    items = [(decode(k), decode(v)) for k, v in value["__dict__"]]
+    return OrderedDict(items) if value["ordered"] else dict(items)
+
+
+def convert_checkpoints(
+    model_folder: PathLike,
+    folds: Sequence[Union[int, str]],
+    checkpoint: str = "model_final_checkpoint",
+    path: Optional[PathLike] = None,
+) -> Path:
+    """Write the weights of the specified folds, the trainer configuration and the plans to a weight store"""
+    from batchgenerators.utilities.file_and_folder_operations import \
+        load_pickle
+
+    model_folder = Path(model_folder)
+    path = weight_store_path(model_folder, checkpoint) if path is None else Path(path)
+    info = load_pickle(str(fold_folder(model_folder, folds[0]) / f"{checkpoint}.model.pkl"))
+    plans = load_pickle(str(model_folder / "plans.pkl"))
+
+    tensors, arrays, offset = {}, [], 0
+    for fold in folds:
+        state_dict = torch.load(str(fold_folder(model_folder, fold) / f"{checkpoint}.model"),
+                                map_location=torch.device("cpu"))["state_dict"]
+        tensors[str(fold)] = {}
+        for name, tensor in state_dict.items():
+            # strip prefix of networks trained with DataParallel (as in trainer.load_checkpoint_ram)
+            name = name[len("module."):] if name.startswith("module.") else name
+            array = np.ascontiguousarray(tensor.detach().cpu().numpy())
+            offset += -offset % ALIGNMENT
+            tensors[str(fold)][name] = dict(dtype=array.dtype.name, shape=list(array.shape), offset=offset)
+            arrays.append((offset, array))
+            offset += array.nbytes
+
+    header = json.dumps(dict(
+        trainer=info["name"],
+        init=encode(tuple(info["init"])),
+        plans=encode(plans),
+        checkpoint=checkpoint,
+        tensors=tensors,
+    )).encode("utf-8")
+    prefix_length = len(MAGIC) + 8
+    header += b" " * (-(prefix_length + len(header)) % ALIGNMENT)
+
+    with atomic_open(path) as fp:
+        fp.write(MAGIC)
+        fp.write(np.array(len(header), dtype="<u8").tobytes())
+        fp.write(header)
+        data_start = fp.tell()
+        for array_offset, array in arrays:
+            fp.write(b"\0" * (data_start + array_offset - fp.tell()))
+            fp.write(array.tobytes())
+    return path
+
+
+def read_header(path: PathLike) -> Tuple[dict, int]:
+    """Header of a weight store, and the offset of the tensors in bytes"""
+    with open(path, "rb") as fp:
+        if fp.read(len(MAGIC)) != MAGIC:
+            raise ValueError(f"Not a weight store: {path}")
+        header_length = int(np.frombuffer(fp.read(8), dtype="<u8")[0])
+        header = json.loads(fp.read(header_length).decode("utf-8"))
+    return header, len(MAGIC) + 8 + header_length
+
+
+def load_weight_store(
+    path: PathLike,
+    folds: Sequence[Union[int, str]],
+    mixed_precision: bool = True,
+) -> Tuple[Any, List[Dict[str, torch.Tensor]]]:
+    """
+    Restore the trainer (equivalent to load_model_and_checkpoint_files, without reading pickles),
+    and the state dict of each fold with tensors backed by the memory-mapped file
+    """
+    import nnunet
+    from nnunet.training.model_restore import recursive_find_python_class
+
+    path = Path(path)
+    header, data_start = read_header(path)
+    missing = [str(fold) for fold in folds if str(fold) not in header["tensors"]]
+    if missing:
+        raise ValueError(f"Folds {missing} not found in weight store {path}, please run `python weight_store.py` first")
+
+    trainer_class = recursive_find_python_class(
+        [os.path.join(nnunet.__path__[0], "training", "network_training")], header["trainer"],
+        current_module="nnunet.training.network_training"
+    )
+    if trainer_class is None:
+        raise RuntimeError(f"Could not find trainer class {header['trainer']}")
+    trainer = trainer_class(*decode(header["init"]))
+    trainer.fp16 = mixed_precision
+    trainer.process_plans(decode(header["plans"]))
+    trainer.output_folder = str(path.parent)
+    trainer.output_folder_base = str(path.parent)
+    trainer.update_fold(0)
+    trainer.initialize(False)
+
+    # copy-on-write mapping: pages are shared with other processes until written (never, for inference)
+    buffer = np.memmap(path, dtype=np.uint8, mode="c")
+    state_dicts = []
+    for fold in folds:
+        state_dict = OrderedDict()
+        for name, info in header["tensors"][str(fold)].items():
+            start = data_start + info["offset"]
+            num_bytes = int(np.prod(info["shape"], dtype=np.int64)) * np.dtype(info["dtype"]).itemsize
+            array = buffer[start:start + num_bytes].view(info["dtype"]).reshape(info["shape"])
+            state_dict[name] = torch.from_numpy(array)
+        state_dicts.append(state_dict)
+    return trainer, state_dicts
+
+
+def assign_weights(network: torch.nn.Module, state_dict: Dict[str, torch.Tensor]) -> None:
+    """Use the tensors of the state dict as parameters and buffers of the network (without copy on CPU)"""
+    tensors = dict(network.named_parameters())
+    tensors.update(network.named_buffers())
+    missing = sorted(set(tensors) - set(state_dict))
+    if missing:
+        raise KeyError(f"Missing tensors in weight store: {missing}")
+    for name, tensor in tensors.items():
+        tensor.data = state_dict[name].to(tensor.device)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Convert the checkpoints of each fold to a memory-mappable weight store")
+    add_model_arguments(parser)
+    args = parser.parse_args()
+
+    model_folder = model_folder_from_args(args)
+    path = convert_checkpoints(
+        model_folder,
+        folds=parse_folds(args.folds),
+        checkpoint=args.checkpoint,
+    )
+    print(f"Saved weight store to {path} ({path.stat().st_size / 1024**2:.1f} MB)")